@@ -0,0 +1,54 @@
+""" bench_subgraphx_workers.py
+    Scaling of SubgraphX with the number of concurrent rollouts: explanation time, speedup and accuracy.
+
+    Runs main.py with --explainer_name subgraphx for each number of workers, in deterministic mode so that
+    every run is reproducible, and parses the __infos and __accuracy lines of its output. Any argument not
+    listed below is passed to main.py.
+
+    Example (from the code directory):
+        python benchmark/bench_subgraphx_workers.py --workers 1,2,4,8 --dataset ba_house --num_test 10 \
+            --explain_graph False --hard_mask False --true_label_as_target False
+"""
+import argparse
+import json
+
+from bench_utils import run_main
+
+
+def get_result(num_workers, infos, accuracy):
+    result = {
+        "subgraphx_workers": num_workers,
+        "num_test_final": infos.get("num_test_final"),
+        "time": infos.get("time"),
+    }
+    # first mask transformation of the sweep
+    if accuracy:
+        result.update({key: value for key, value in accuracy[0].items() if key not in result})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", help="comma-separated numbers of concurrent rollouts", type=str, default="1,2,4,8")
+    parser.add_argument("--subgraphx_deterministic", type=str, default="True")
+    args, main_args = parser.parse_known_args()
+
+    results = []
+    for num_workers in [int(w) for w in args.workers.split(",")]:
+        run_args = main_args + [
+            "--explainer_name", "subgraphx",
+            "--subgraphx_workers", str(num_workers),
+            "--subgraphx_deterministic", args.subgraphx_deterministic,
+        ]
+        infos, accuracy = run_main(run_args)
+        results.append(get_result(num_workers, infos, accuracy))
+
+    base_time = results[0]["time"]
+    for result in results:
+        if base_time and result["time"]:
+            result["speedup"] = base_time / result["time"]
+        print("__subgraphx_workers_benchmark:" + json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+""" bench_utils.py
+    Helpers of the benchmark scripts: run main.py in a subprocess and parse the JSON lines of its output.
+"""
+import json
+import os
+import subprocess
+import sys
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+def parse_output(output, prefix):
+    """JSON values of the output lines starting with prefix."""
+    values = []
+    for line in output.splitlines():
+        if line.startswith(prefix):
+            values.append(json.loads(line[len(prefix) :]))
+    return values
+
+
+def run_main(main_args):
+    """Run main.py with main_args and return its last __infos and its __accuracy values."""
+    cmd = [sys.executable, MAIN] + main_args
+    print("Running: " + " ".join(cmd))
+    output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    infos = parse_output(output, "__infos:")
+    accuracy = parse_output(output, "__accuracy:")
+    return infos[-1] if infos else {}, accuracy
@@ -0,0 +1,60 @@
+""" bench_warm_start.py
+    Compare GNNExplainer with random and warm-started edge masks: epochs to converge, time and accuracy.
+
+    Runs main.py with early stopping, once with --warm_start False and once with --warm_start True, and
+    parses the __infos and __accuracy lines of its output. Any argument not listed below is passed to main.py.
+
+    Example (from the code directory):
+        python benchmark/bench_warm_start.py --dataset ba_house --num_test 100 --explain_graph False --hard_mask False \
+            --true_label_as_target False
+"""
+import argparse
+import json
+
+from bench_utils import run_main
+
+
+def get_result(warm_start, infos, accuracy):
+    result = {
+        "warm_start": warm_start,
+        "num_test_final": infos.get("num_test_final"),
+        "time": infos.get("time"),
+        "max_epochs": infos.get("max_epochs"),
+        "mean_stopped_epoch": infos.get("mean_stopped_epoch"),
+        "early_stopping_saved_time": infos.get("early_stopping_saved_time"),
+    }
+    # first mask transformation of the sweep
+    if accuracy:
+        result.update({key: value for key, value in accuracy[0].items() if key not in result})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--es_patience", type=int, default=50)
+    parser.add_argument("--es_rel_tol", type=float, default=1e-3)
+    parser.add_argument("--es_mask_tol", type=float, default=1e-2)
+    args, main_args = parser.parse_known_args()
+
+    results = []
+    for warm_start in ["False", "True"]:
+        run_args = main_args + [
+            "--explainer_name", "gnnexplainer",
+            "--early_stopping", "True",
+            "--es_patience", str(args.es_patience),
+            "--es_rel_tol", str(args.es_rel_tol),
+            "--es_mask_tol", str(args.es_mask_tol),
+            "--warm_start", warm_start,
+        ]
+        infos, accuracy = run_main(run_args)
+        results.append(get_result(warm_start, infos, accuracy))
+
+    for result in results:
+        print("__warm_start_benchmark:" + json.dumps(result))
+    cold, warm = results
+    if cold["mean_stopped_epoch"] and warm["mean_stopped_epoch"]:
+        print(f"Mean epochs to converge: {cold['mean_stopped_epoch']:.1f} (random) vs {warm['mean_stopped_epoch']:.1f} (warm start)")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,70 +5,159 @@
 import numpy as np
 from sympy import re
 import torch
-from utils.gen_utils import list_to_dict, get_proba
+from utils.cache_utils import cached_k_hop_subgraph
+from utils.gen_utils import LOCAL_INFERENCE_FLOW, list_to_dict, get_proba
+from explainer.node_explainer import local_inference_holds
 
-def eval_related_pred_nc(model, data, edge_masks, node_feat_masks, list_node_idx, device, args):
-    """ Evaluate related predictions for a single node.
 
-    Args:
-        model: trained GNN model
-        data: initial data object
-        edge_masks: edge masks for the testing node
-        node_feat_masks: node features masks for the testing node
-        list_node_idx: list of testing nodes
+def get_local_masked_graphs(data, edge_masks, node_feat_masks, i, node_idx, device, args):
+    """ Masked and maskout graphs of the i-th testing node, restricted to its computation subgraph.
 
     Returns:
-        related_pred: dictionary of related predictions with masked and maskout predictions
+        list of two (x, edge_index, edge_weight, mapping) tuples, for the masked and the maskout graph.
+        With hard masks, the kept edges have weight 1, as when the model is called without edge_weight.
     """
-    related_preds = []
-    data = data.to(device)
-    ori_ypred = model(data.x, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
-    ori_yprob = get_proba(ori_ypred)
-    
-    num_test = args.num_test_final if args.E else args.num_test
-
-    for i in range(num_test):
+    subset, sub_edge_index, mapping, sub_edge_mask = cached_k_hop_subgraph(
+        node_idx, args.num_gc_layers, data.edge_index, num_nodes=data.num_nodes, flow=LOCAL_INFERENCE_FLOW
+    )
+    x = data.x[subset]
+    if not args.NF:
+        x_masked, x_maskout = x, x
+    else:
+        node_feat_mask = torch.Tensor(node_feat_masks[i]).to(device)
+        if node_feat_mask.dim() == 2:
+            x_masked = node_feat_mask[subset]
+            x_maskout = (1 - node_feat_mask[subset])
+        else:
+            x_masked = x * node_feat_mask
+            x_maskout = x * (1 - node_feat_mask)
 
-        if not args.NF:
-            x_masked = data.x
-            x_maskout = data.x
+    if eval(args.hard_mask):
+        if not args.E:
+            keep_masked = keep_maskout = torch.ones(sub_edge_index.size(1), dtype=torch.bool, device=device)
         else:
-            node_feat_mask = torch.Tensor(node_feat_masks[i]).to(device)
-            if node_feat_mask.dim() == 2:
-                x_masked = node_feat_mask
-                x_maskout = (1 - node_feat_mask)
-            else:
-                x_masked = data.x * node_feat_mask
-                x_maskout = data.x * (1 - node_feat_mask)
-        
+            edge_mask = torch.Tensor(edge_masks[i]).to(device)[sub_edge_mask]
+            keep_masked, keep_maskout = edge_mask > 0, edge_mask <= 0
+        masked_edge_index, maskout_edge_index = sub_edge_index[:, keep_masked], sub_edge_index[:, keep_maskout]
+        masked_edge_weight = torch.ones(masked_edge_index.size(1), device=device)
+        maskout_edge_weight = torch.ones(maskout_edge_index.size(1), device=device)
+    else:
+        edge_weight = data.edge_weight[sub_edge_mask]
+        masked_edge_index = maskout_edge_index = sub_edge_index
         if not args.E:
-            if eval(args.hard_mask):
-                masked_ypred = model(x_masked, data.edge_index).cpu().detach().numpy()
-                maskout_ypred = model(x_maskout, data.edge_index).cpu().detach().numpy()
-            else:
-                masked_ypred = model(x_masked, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
-                maskout_ypred = model(x_maskout, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
-
+            masked_edge_weight = maskout_edge_weight = edge_weight
         else:
-            edge_mask = torch.Tensor(edge_masks[i]).to(device)
-            if eval(args.hard_mask):
-                masked_edge_index = data.edge_index[:, edge_mask > 0].to(device)
-                maskout_edge_index = data.edge_index[:, edge_mask <= 0].to(device)
-                masked_ypred = model(x_masked, masked_edge_index).cpu().detach().numpy()
-                maskout_ypred = model(x_maskout, maskout_edge_index).cpu().detach().numpy()
-            else:
-                masked_ypred = model(x_masked, data.edge_index, edge_weight=data.edge_weight*edge_mask).cpu().detach().numpy()
-                maskout_ypred = model(x_maskout, data.edge_index, edge_weight=data.edge_weight*(1-edge_mask)).cpu().detach().numpy()
-            edge_mask = edge_mask.cpu().detach().numpy()
-        
-        
-        node_idx = list_node_idx[i]
-        masked_yprob = get_proba(masked_ypred)
-        maskout_yprob = get_proba(maskout_ypred)
+            edge_mask = torch.Tensor(edge_masks[i]).to(device)[sub_edge_mask]
+            masked_edge_weight = edge_weight * edge_mask
+            maskout_edge_weight = edge_weight * (1 - edge_mask)
+
+    mapping = int(mapping[0])
+    return [
+        (x_masked, masked_edge_index, masked_edge_weight, mapping),
+        (x_maskout, maskout_edge_index, maskout_edge_weight, mapping),
+    ]
+
+
+def forward_disjoint_union(model, graphs):
+    """ Run the model once on the disjoint union of the graphs and return the predictions of their target node. """
+    xs, edge_indices, edge_weights, out_indices = [], [], [], []
+    offset = 0
+    for x, edge_index, edge_weight, mapping in graphs:
+        xs.append(x)
+        edge_indices.append(edge_index + offset)
+        edge_weights.append(edge_weight)
+        out_indices.append(offset + mapping)
+        offset += x.size(0)
+    ypred = model(torch.cat(xs), torch.cat(edge_indices, dim=1), edge_weight=torch.cat(edge_weights))
+    return ypred[out_indices].cpu().detach().numpy()
+
+
+def get_union_max_nodes(model, args):
+    """ Max number of nodes of a disjoint union of graphs.
+
+    args.fidelity_max_nodes bounds the memory of the sparse models. A model with a dense adjacency (GcnEncoderNode
+    with --sparse_adj False) allocates N x N values for the union: its unions are capped at the size up to which
+    the auto mode keeps the dense adjacency, args.sparse_adj_threshold.
+    """
+    if hasattr(model, "use_sparse_adj") and not model.use_sparse_adj(args.fidelity_max_nodes):
+        return min(args.fidelity_max_nodes, model.sparse_adj_threshold)
+    return args.fidelity_max_nodes
+
+
+def use_batched_fidelity(model, data, list_node_idx, args):
+    """ Whether the fidelity is evaluated in batches on the computation subgraphs of the testing nodes.
+
+    The batches give the full-graph predictions only if the prediction of a node depends on its num_gc_layers-hop
+    subgraph alone: this is checked once on the testing nodes (see local_inference_holds).
+    """
+    if args.fidelity_batch_size <= 1:
+        return False
+    return local_inference_holds(
+        model,
+        data.x,
+        data.edge_index,
+        data.edge_weight,
+        args.num_gc_layers,
+        list_node_idx=list_node_idx,
+        num_checks=args.local_inference_checks,
+    )
+
 
+def eval_masked_ypreds_batch(model, node_graphs, args):
+    """ Predictions of the target nodes of the masked graphs, computed in batches.
+
+    The graphs of up to args.fidelity_batch_size testing nodes are stacked into a single block-diagonal graph,
+    so that one forward replaces all their full-graph forwards. A batch never holds more than
+    get_union_max_nodes nodes, unless the graphs of a single testing node need more.
+
+    Args:
+        node_graphs: iterable of lists of (x, edge_index, edge_weight, mapping), one list per testing node
+
+    Returns:
+        ypreds: predictions of the target nodes, one row per graph, in order
+    """
+    ypreds = []
+    max_nodes = get_union_max_nodes(model, args)
+    graphs, num_graph_nodes, num_nodes = [], 0, 0
+    with torch.no_grad():
+        for graphs_i in node_graphs:
+            num_nodes_i = sum(graph[0].size(0) for graph in graphs_i)
+            if graphs and (
+                num_graph_nodes >= args.fidelity_batch_size or num_nodes + num_nodes_i > max_nodes
+            ):
+                ypreds.append(forward_disjoint_union(model, graphs))
+                graphs, num_graph_nodes, num_nodes = [], 0, 0
+            graphs.extend(graphs_i)
+            num_graph_nodes += 1
+            num_nodes += num_nodes_i
+        if graphs:
+            ypreds.append(forward_disjoint_union(model, graphs))
+    return np.concatenate(ypreds)
+
+
+def eval_related_pred_nc_batch(model, data, edge_masks, node_feat_masks, list_node_idx, device, args):
+    """ Masked and maskout predictions of the testing nodes, computed on their computation subgraphs in batches.
+
+    Returns:
+        masked_ypreds, maskout_ypreds: predictions of the testing nodes, one row per node
+    """
+    num_test = args.num_test_final if args.E else args.num_test
+    node_graphs = (
+        get_local_masked_graphs(data, edge_masks, node_feat_masks, i, list_node_idx[i], device, args)
+        for i in range(num_test)
+    )
+    ypreds = eval_masked_ypreds_batch(model, node_graphs, args)
+    return ypreds[0::2], ypreds[1::2]
+
+
+def get_related_preds(data, ori_yprob, masked_ypreds, maskout_ypreds, list_node_idx, num_test):
+    """ Gather the related predictions of the testing nodes from the rows of their masked and maskout predictions. """
+    related_preds = []
+    for i in range(num_test):
+        node_idx = list_node_idx[i]
+        masked_probs = get_proba(masked_ypreds[[i]])[0]
+        maskout_probs = get_proba(maskout_ypreds[[i]])[0]
         ori_probs = ori_yprob[node_idx]
-        masked_probs = masked_yprob[node_idx]
-        maskout_probs = maskout_yprob[node_idx]
         true_label = data.y[node_idx].cpu().numpy()
         pred_label = np.argmax(ori_probs)
        
@@ -89,6 +178,109 @@ def eval_related_pred_nc(model, data, edge_masks, node_feat_masks, list_node_idx
     return related_preds
 
 
+def eval_masked_ypred_nc(model, data, edge_masks, node_feat_masks, i, device, args):
+    """ Full-graph predictions of the masked and maskout graphs of the i-th testing node. """
+    if not args.NF:
+        x_masked = data.x
+        x_maskout = data.x
+    else:
+        node_feat_mask = torch.Tensor(node_feat_masks[i]).to(device)
+        if node_feat_mask.dim() == 2:
+            x_masked = node_feat_mask
+            x_maskout = (1 - node_feat_mask)
+        else:
+            x_masked = data.x * node_feat_mask
+            x_maskout = data.x * (1 - node_feat_mask)
+
+    if not args.E:
+        if eval(args.hard_mask):
+            masked_ypred = model(x_masked, data.edge_index).cpu().detach().numpy()
+            maskout_ypred = model(x_maskout, data.edge_index).cpu().detach().numpy()
+        else:
+            masked_ypred = model(x_masked, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
+            maskout_ypred = model(x_maskout, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
+
+    else:
+        edge_mask = torch.Tensor(edge_masks[i]).to(device)
+        if eval(args.hard_mask):
+            masked_edge_index = data.edge_index[:, edge_mask > 0].to(device)
+            maskout_edge_index = data.edge_index[:, edge_mask <= 0].to(device)
+            masked_ypred = model(x_masked, masked_edge_index).cpu().detach().numpy()
+            maskout_ypred = model(x_maskout, maskout_edge_index).cpu().detach().numpy()
+        else:
+            masked_ypred = model(x_masked, data.edge_index, edge_weight=data.edge_weight*edge_mask).cpu().detach().numpy()
+            maskout_ypred = model(x_maskout, data.edge_index, edge_weight=data.edge_weight*(1-edge_mask)).cpu().detach().numpy()
+    return masked_ypred, maskout_ypred
+
+
+def eval_related_pred_nc(model, data, edge_masks, node_feat_masks, list_node_idx, device, args):
+    """ Evaluate related predictions for a single node.
+
+    Args:
+        model: trained GNN model
+        data: initial data object
+        edge_masks: edge masks for the testing node
+        node_feat_masks: node features masks for the testing node
+        list_node_idx: list of testing nodes
+
+    Returns:
+        related_pred: dictionary of related predictions with masked and maskout predictions
+    """
+    related_preds = []
+    data = data.to(device)
+    ori_ypred = model(data.x, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
+    ori_yprob = get_proba(ori_ypred)
+    
+    num_test = args.num_test_final if args.E else args.num_test
+    if use_batched_fidelity(model, data, list_node_idx[:num_test], args):
+        masked_ypreds, maskout_ypreds = eval_related_pred_nc_batch(
+            model, data, edge_masks, node_feat_masks, list_node_idx, device, args
+        )
+    else:
+        masked_ypreds, maskout_ypreds = [], []
+        for i in range(num_test):
+            node_idx = list_node_idx[i]
+            masked_ypred, maskout_ypred = eval_masked_ypred_nc(model, data, edge_masks, node_feat_masks, i, device, args)
+            masked_ypreds.append(masked_ypred[node_idx])
+            maskout_ypreds.append(maskout_ypred[node_idx])
+        masked_ypreds, maskout_ypreds = np.array(masked_ypreds), np.array(maskout_ypreds)
+    return get_related_preds(data, ori_yprob, masked_ypreds, maskout_ypreds, list_node_idx, num_test)
+
+
+def eval_related_pred_nc_sweep(model, data, edge_masks_sweep, node_feat_masks, list_node_idx, device, args):
+    """ Evaluate the related predictions for each transformation level of the edge masks.
+
+    With batched fidelity, the masked graphs of all the levels are evaluated in one batched pass
+    and the original predictions are computed once.
+
+    Args:
+        edge_masks_sweep: list of edge masks, one per transformation level (see transform_mask_sweep)
+
+    Returns:
+        list of related_preds dictionaries, one per transformation level
+    """
+    data = data.to(device)
+    num_test = args.num_test_final if args.E else args.num_test
+    if not use_batched_fidelity(model, data, list_node_idx[:num_test], args):
+        return [
+            eval_related_pred_nc(model, data, edge_masks, node_feat_masks, list_node_idx, device, args)
+            for edge_masks in edge_masks_sweep
+        ]
+    ori_ypred = model(data.x, data.edge_index, edge_weight=data.edge_weight).cpu().detach().numpy()
+    ori_yprob = get_proba(ori_ypred)
+    node_graphs = (
+        get_local_masked_graphs(data, edge_masks, node_feat_masks, i, list_node_idx[i], device, args)
+        for edge_masks in edge_masks_sweep
+        for i in range(num_test)
+    )
+    ypreds = eval_masked_ypreds_batch(model, node_graphs, args)
+    ypreds = ypreds.reshape(len(edge_masks_sweep), num_test, 2, -1)
+    return [
+        get_related_preds(data, ori_yprob, ypreds[k, :, 0], ypreds[k, :, 1], list_node_idx, num_test)
+        for k in range(len(edge_masks_sweep))
+    ]
+
+
 
 def fidelity_acc(related_preds):
     labels = related_preds["true_label"]
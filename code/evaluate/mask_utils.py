@@ -143,6 +143,29 @@ def transform_mask(masks, data, param, args):
     return np.array(new_masks, dtype=np.float64)
 
 
+def transform_mask_sweep(masks, data, params, args):
+    """Transform masks for all the levels in params, as transform_mask does for each level.
+
+    Each mask is sorted once and the top-k and sparsity levels are read from the same order.
+    Returns a list with one array of transformed masks per level.
+    """
+    if args.strategy == 'topk' and not eval(args.directed):
+        return [transform_mask(masks, data, param, args) for param in params]
+    new_masks = [[] for _ in params]
+    for mask_ori in masks:
+        order = (-mask_ori).argsort() if args.strategy in ['topk', 'sparsity'] else None
+        for k, param in enumerate(params):
+            mask = mask_ori.copy()
+            if args.strategy == 'topk':
+                mask[order[param:]] = 0
+            if args.strategy == 'sparsity':
+                mask[order[int((1 - param) * len(mask)):]] = 0
+            if args.strategy == 'threshold':
+                mask = np.where(mask > param, mask, 0)
+            new_masks[k].append(mask)
+    return [np.array(new_masks_k, dtype=np.float64) for new_masks_k in new_masks]
+
+
 def mask_to_shape(mask, edge_index, num_top_edges):
     """Modify the mask by selecting only the num_top_edges edges with the highest mask value."""
     indices = topk_edges_unique(mask, edge_index, num_top_edges)
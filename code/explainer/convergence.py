@@ -0,0 +1,132 @@
+""" convergence.py
+    Early stopping of the mask-learning explainers.
+"""
+import numpy as np
+import torch
+
+# node_idx -> (stopped epoch, epoch budget) of the node explanations computed in this process
+_stopped_epochs = {}
+# explainer name -> (stopped epoch, epoch budget) of the explanation networks trained in this process
+_training_stopped_epochs = {}
+
+
+def get_early_stopping_params(args):
+    """Keyword arguments of ConvergenceMonitor, or None if early stopping is disabled."""
+    if not eval(args.early_stopping):
+        return None
+    return {"patience": args.es_patience, "rel_tol": args.es_rel_tol, "mask_tol": args.es_mask_tol}
+
+
+class ConvergenceMonitor(object):
+    """Detect the convergence of the optimization of one or several independent masks.
+
+    A mask has converged when, for `patience` epochs, its loss has not moved by more than `rel_tol` (relative)
+    and its values have not moved by more than `mask_tol` (absolute) from the start of the window.
+    Any larger change restarts the window. Several masks (e.g. the nodes of a batched explanation) are monitored
+    at once by giving one loss per mask and the segment of each mask value.
+
+    Args:
+        num_masks (int): number of monitored masks.
+    """
+
+    def __init__(self, num_masks=1, patience=50, rel_tol=1e-3, mask_tol=1e-2):
+        self.num_masks = num_masks
+        self.patience = patience
+        self.rel_tol = rel_tol
+        self.mask_tol = mask_tol
+        self.window_start = np.zeros(num_masks, dtype=int)
+        self.window_loss = None
+        self.window_mask = None
+        self.stopped_epochs = np.full(num_masks, -1)
+
+    @property
+    def converged(self):
+        return self.stopped_epochs >= 0
+
+    def update(self, epoch, losses, mask=None, segment=None):
+        """Record the losses and mask values at the end of an epoch.
+
+        Args:
+            losses: loss of each mask, of size num_masks.
+            mask (Tensor, optional): values of all the masks, concatenated.
+            segment (LongTensor, optional): mask index of each value of mask. All values belong to the
+                first mask if not given.
+
+        Returns:
+            boolean array, True for the masks that converged at this epoch.
+        """
+        losses = np.asarray(torch.as_tensor(losses).detach().cpu(), dtype=np.float64).reshape(-1)
+        if mask is not None:
+            mask = mask.detach().clone()
+        if self.window_loss is None:
+            self.window_loss = losses.copy()
+            self.window_mask = mask
+            return np.zeros(self.num_masks, dtype=bool)
+
+        moved = np.abs(losses - self.window_loss) > self.rel_tol * np.maximum(np.abs(self.window_loss), 1e-12)
+        if mask is not None:
+            diff = (mask - self.window_mask).abs().view(mask.size(0), -1).amax(dim=1)
+            if segment is None:
+                segment = torch.zeros(mask.size(0), dtype=torch.long, device=mask.device)
+            max_diff = np.zeros(self.num_masks)
+            np.maximum.at(max_diff, segment.cpu().numpy(), diff.cpu().numpy())
+            moved |= max_diff > self.mask_tol
+
+        restart = moved & ~self.converged
+        if restart.any():
+            self.window_start[restart] = epoch
+            self.window_loss[restart] = losses[restart]
+            if mask is not None:
+                restart_values = torch.as_tensor(restart, device=mask.device)[segment]
+                self.window_mask[restart_values] = mask[restart_values]
+
+        newly_converged = ~self.converged & ~moved & (epoch - self.window_start >= self.patience)
+        self.stopped_epochs[newly_converged] = epoch
+        return newly_converged
+
+
+def record_stopped_epoch(node_idx, stopped_epoch, max_epochs):
+    _stopped_epochs[node_idx] = (int(stopped_epoch), int(max_epochs))
+
+
+def record_training_stopped_epoch(explainer_name, stopped_epoch, max_epochs):
+    _training_stopped_epochs[explainer_name] = (int(stopped_epoch), int(max_epochs))
+
+
+def pop_stopped_epochs():
+    """Return and forget the stopped epochs recorded in this process."""
+    stopped_epochs = (dict(_stopped_epochs), dict(_training_stopped_epochs))
+    _stopped_epochs.clear()
+    _training_stopped_epochs.clear()
+    return stopped_epochs
+
+
+def merge_stopped_epochs(stopped_epochs):
+    """Record the stopped epochs returned by pop_stopped_epochs in another process."""
+    _stopped_epochs.update(stopped_epochs[0])
+    _training_stopped_epochs.update(stopped_epochs[1])
+
+
+def get_convergence_infos(stopped_epochs, list_node_idx, durations):
+    """Summary of early stopping for the run infos.
+
+    The saved time of a node is estimated from its duration per epoch and the number of epochs it skipped.
+    """
+    node_stopped_epochs, training_stopped_epochs = stopped_epochs
+    infos = {}
+    for explainer_name, (stopped_epoch, max_epochs) in training_stopped_epochs.items():
+        infos[f"{explainer_name}_training_stopped_epoch"] = stopped_epoch
+        infos[f"{explainer_name}_training_max_epochs"] = max_epochs
+    epochs, saved_time = [], 0.0
+    for node_idx, duration in zip(list_node_idx, durations):
+        if node_idx not in node_stopped_epochs:
+            continue
+        stopped_epoch, max_epochs = node_stopped_epochs[node_idx]
+        epochs.append(stopped_epoch)
+        saved_time += duration / max(stopped_epoch, 1) * (max_epochs - stopped_epoch)
+        infos["max_epochs"] = max_epochs
+    if epochs:
+        infos["stopped_epochs"] = epochs
+        infos["mean_stopped_epoch"] = float(np.mean(epochs))
+        infos["early_stopping_saved_time"] = float(format(saved_time, ".4f"))
+    return infos
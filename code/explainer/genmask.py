@@ -1,39 +1,340 @@
+import copy
+import hashlib
+import signal
+import threading
 import time
-from utils.gen_utils import get_labels
+from utils.cache_utils import subgraph_cache
+from utils.gen_utils import get_labels, set_node_seed
+from utils.graph_utils import split_batch
+from utils.mask_store import get_mask_store
 
 import torch
+import torch.multiprocessing as mp
 
+from explainer.convergence import get_convergence_infos, merge_stopped_epochs, pop_stopped_epochs
+from explainer.subgraphx import reward_cache, reward_evaluations
+from explainer.warm_start import EdgeMaskBank, set_warm_start_bank
 from explainer.graph_explainer import *
 from explainer.node_explainer import *
 
+# State of a worker process of the parallel explanation engine, filled once by `init_explain_worker`.
+_worker_state = {}
 
-def compute_edge_masks_nc(list_test_nodes, model, data, device, args):
+
+def get_targets(model, data, device, args):
+    if eval(args.true_label_as_target):
+        return data.y
+    out = model(data.x, data.edge_index, edge_weight=data.edge_weight)
+    return torch.LongTensor(get_labels(out.detach().cpu().numpy())).to(device)
+
+
+def explain_node(explain_function, model, data, node_idx, targets, device, args):
+    """Explain a single node and return its edge mask, node feature mask and duration.
+
+    The random generators are reseeded from (args.seed, node_idx) so that the result of a node
+    is the same whether it is explained serially, in a worker process or in another order.
+    """
+    set_node_seed(args.seed, node_idx)
+    inputs = get_explain_inputs(data, device, args)
+    guard = InputGuard(inputs, check_content=eval(args.check_inputs))
+    start_time = time.time()
+    edge_mask, node_feat_mask = explain_function(
+        model, data, node_idx, *inputs, targets[node_idx], device, args
+    )
+    end_time = time.time()
+    guard.check(args.explainer_name)
+    return edge_mask, node_feat_mask, end_time - start_time
+
+
+def explain_node_batch(explain_batch_function, model, data, list_node_idx, targets, device, args):
+    """Explain several nodes in one call of a batched explainer and return their results as explain_node does.
+
+    The duration of the batch is shared equally between its nodes.
+    """
+    inputs = get_explain_inputs(data, device, args)
+    guard = InputGuard(inputs, check_content=eval(args.check_inputs))
+    start_time = time.time()
+    masks = explain_batch_function(model, data, list_node_idx, *inputs, targets[list_node_idx], device, args)
+    end_time = time.time()
+    guard.check(args.explainer_name)
+    duration = (end_time - start_time) / len(list_node_idx)
+    return [(edge_mask, node_feat_mask, duration) for edge_mask, node_feat_mask in masks]
+
+
+def get_explain_data(data):
+    """Shallow copy of data with x and edge_weight in float and edge_index in long, the dtypes the explainers expect.
+
+    It is built once per run: the tensors already in these dtypes are shared with data, not copied.
+    """
+    explain_data = copy.copy(data)
+    explain_data.x = data.x.float()
+    explain_data.edge_index = data.edge_index.long()
+    explain_data.edge_weight = data.edge_weight.float()
+    return explain_data
+
+
+def get_explain_inputs(data, device, args):
+    """Return the (x, edge_index, edge_weight) tensors handed to the explainer.
+
+    The tensors of `data` are shared by all the nodes and must be treated as read-only.
+    Only the explainers listed in INPLACE_EXPLAINERS modify their inputs and receive a private copy.
+    """
+    inputs = (data.x.to(device), data.edge_index.to(device), data.edge_weight.to(device))
+    if args.explainer_name in INPLACE_EXPLAINERS:
+        inputs = tuple(item.clone() for item in inputs)
+    return inputs
+
+
+class InputGuard(object):
+    """Detect in-place modifications of the shared explainer inputs.
+
+    Every in-place torch operation bumps the version counter of a tensor. Writes through a numpy
+    view (`tensor.numpy()`) bypass the counter and are only caught with `check_content=True`,
+    which hashes the content of the tensors before and after the explanation.
+    """
+
+    def __init__(self, tensors, check_content=False):
+        self.tensors = tensors
+        self.check_content = check_content
+        self.versions = [tensor._version for tensor in tensors]
+        self.digests = [self.digest(tensor) for tensor in tensors] if check_content else None
+
+    @staticmethod
+    def digest(tensor):
+        return hashlib.sha1(tensor.detach().cpu().numpy().tobytes()).hexdigest()
+
+    def check(self, explainer_name):
+        modified = [tensor._version != version for tensor, version in zip(self.tensors, self.versions)]
+        if self.check_content:
+            modified = [
+                m or self.digest(tensor) != digest for m, tensor, digest in zip(modified, self.tensors, self.digests)
+            ]
+        if any(modified):
+            names = [name for name, m in zip(["x", "edge_index", "edge_weight"], modified) if m]
+            raise RuntimeError(
+                f"Explainer {explainer_name} modified its shared inputs {names} in place. "
+                "Add it to INPLACE_EXPLAINERS so that it receives a private copy."
+            )
+
+
+def init_explain_worker(model, data, targets, device, args, num_threads):
+    # the workers share the cores of the parent process
+    torch.set_num_threads(num_threads)
+    subgraph_cache.resize(args.subgraph_cache_size)
+    reward_cache.resize(args.reward_cache_size)
+    _worker_state["explain_function"] = eval("explain_" + args.explainer_name + "_node")
+    _worker_state["model"] = model
+    _worker_state["data"] = data
+    _worker_state["targets"] = targets
+    _worker_state["device"] = device
+    _worker_state["args"] = args
+
+
+def pop_worker_stats():
+    """Return and reset the stopped epochs, cache counts and reward evaluations recorded in this process."""
+    reward_infos = reward_evaluations.info()
+    reward_evaluations.clear()
+    return pop_stopped_epochs(), subgraph_cache.pop_counts(), reward_cache.pop_counts(), reward_infos
+
+
+def merge_worker_stats(stats):
+    """Record the stats returned by pop_worker_stats in a worker process."""
+    stopped_epochs, subgraph_counts, reward_counts, reward_infos = stats
+    merge_stopped_epochs(stopped_epochs)
+    subgraph_cache.merge_counts(subgraph_counts)
+    reward_cache.merge_counts(reward_counts)
+    reward_evaluations.merge(reward_infos)
+
+
+def explain_node_worker(node_idx):
+    """Explain a node in a worker process, and send back the stats recorded during the explanation."""
+    result = explain_node(
+        _worker_state["explain_function"],
+        _worker_state["model"],
+        _worker_state["data"],
+        node_idx,
+        _worker_state["targets"],
+        _worker_state["device"],
+        _worker_state["args"],
+    )
+    return result, pop_worker_stats()
+
+
+def iter_explain_nodes_serial(list_test_nodes, model, data, targets, device, args):
+    if args.explain_batch_size > 1 and args.explainer_name in BATCH_EXPLAINERS:
+        explain_batch_function = eval("explain_" + args.explainer_name + "_nodes")
+        for list_node_idx in split_batch(list_test_nodes, args.explain_batch_size):
+            for result in explain_node_batch(explain_batch_function, model, data, list_node_idx, targets, device, args):
+                yield result
+        return
     explain_function = eval("explain_" + args.explainer_name + "_node")
+    for node_idx in list_test_nodes:
+        yield explain_node(explain_function, model, data, node_idx, targets, device, args)
+
+
+def iter_explain_nodes_parallel(list_test_nodes, model, data, targets, device, args):
+    """Shard the test nodes across a pool of `args.explain_workers` processes.
+
+    The model and the graph tensors are moved to shared memory so that each worker loads them once
+    without copying. Each worker gets an equal share of the threads of the parent process and the cache sizes
+    of the run, and sends back its cache counts with each result. Results are yielded in the order of
+    `list_test_nodes`.
+    """
+    model.share_memory()
+    for key in ["x", "edge_index", "edge_weight", "y"]:
+        item = getattr(data, key, None)
+        if torch.is_tensor(item) and item.device.type == "cpu":
+            item.share_memory_()
+    if targets.device.type == "cpu":
+        targets.share_memory_()
+    ctx = mp.get_context("spawn")
+    num_threads = max(1, torch.get_num_threads() // args.explain_workers)
+    pool = ctx.Pool(
+        processes=args.explain_workers,
+        initializer=init_explain_worker,
+        initargs=(model, data, targets, device, args, num_threads),
+    )
+    try:
+        for result, stats in pool.imap(explain_node_worker, list_test_nodes):
+            merge_worker_stats(stats)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class MaskCheckpointer(object):
+    """Write the masks of the explained nodes to the mask store every `checkpoint_every` nodes.
+
+    The pending masks are also written when the run is stopped by SIGTERM (e.g. preemption by a scheduler),
+    so that a run resumed with --resume True only explains the nodes that were never finished.
+    """
+
+    def __init__(self, store, checkpoint_every=1):
+        self.store = store
+        self.checkpoint_every = max(checkpoint_every, 1)
+        self.pending = []
+        self.previous_handler = None
+
+    def add(self, node_idx, result):
+        if self.store is None:
+            return
+        self.pending.append((node_idx, result))
+        if len(self.pending) >= self.checkpoint_every:
+            self.flush()
+
+    def flush(self):
+        while self.pending:
+            node_idx, result = self.pending[0]
+            self.store.save(node_idx, *result)
+            self.pending.pop(0)
+
+    def handle_sigterm(self, signum, frame):
+        # the pending masks are written by the `finally` clause of the explanation loop
+        raise SystemExit(128 + signum)
+
+    def __enter__(self):
+        if self.store is not None and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signal.SIGTERM, self.handle_sigterm)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.flush()
+        finally:
+            if self.previous_handler is not None:
+                signal.signal(signal.SIGTERM, self.previous_handler)
+                self.previous_handler = None
+
+
+def use_warm_start(args):
+    """Whether the explanations are warm-started. Warm start needs the masks of the previous nodes before
+    explaining the next one and is therefore disabled with parallel workers."""
+    return eval(args.warm_start) and args.explainer_name in WARM_START_EXPLAINERS and args.explain_workers <= 1
+
+
+def get_warm_start_bank(data, args):
+    """Bank of the learned edge masks used to warm-start the next explanations, or None if warm start is off.
+
+    The masks are added in the order of the testing nodes, stored masks included, so that the initialization
+    of a node only depends on the nodes before it.
+    """
+    if not use_warm_start(args):
+        if eval(args.warm_start) and args.explain_workers > 1:
+            print("Warm start is not supported with explain_workers > 1, masks are initialized randomly")
+        return None
+    bank = EdgeMaskBank(data.edge_index.size(1))
+    set_warm_start_bank(bank)
+    return bank
+
+
+def compute_edge_masks_nc(list_test_nodes, model, data, device, args):
+    """Explain the testing nodes and return their edge masks, node feature masks and durations.
+
+    With a mask store (--mask_cache reuse/refresh or --resume True), the masks are checkpointed to disk and,
+    in reuse mode, the stored nodes are not explained again. The recorded durations of the reused nodes count
+    towards args.time_limit. They are the durations of the explanations only, while the explained nodes count
+    their wall-clock time, so a resumed run stops at about the same node as an uninterrupted run would.
+    """
     Time = []
     edge_masks, node_feat_masks = [], []
-    if eval(args.true_label_as_target):
-        targets = data.y
-    else:
-        out = model(data.x, data.edge_index, edge_weight=data.edge_weight)
-        targets = torch.LongTensor(get_labels(out.detach().cpu().numpy())).to(device)
-    t0 = time.time()
-    for node_idx in list_test_nodes:
-        x = torch.FloatTensor(data.x.cpu().numpy().copy()).to(device)
-        edge_index = torch.LongTensor(data.edge_index.cpu().numpy().copy()).to(device)
-        edge_weight = torch.FloatTensor(data.edge_weight.cpu().numpy().copy()).to(device)
-        start_time = time.time()
-        edge_mask, node_feat_mask = explain_function(
-            model, data, node_idx, x, edge_index, edge_weight, targets[node_idx], device, args
+    pop_stopped_epochs()
+    if eval(args.resume) and args.mask_cache == "off":
+        args.mask_cache = "reuse"
+    # a warm-started mask depends on the nodes explained before it: the masks are only reused for the same
+    # ordered list of testing nodes
+    store = get_mask_store(model, data, args, ordered_nodes=list_test_nodes if use_warm_start(args) else None)
+    results = {}
+    if store is not None and args.mask_cache == "reuse":
+        for node_idx in list_test_nodes:
+            result = store.load(node_idx)
+            if result is not None:
+                results[node_idx] = result
+    list_explain_nodes = [node_idx for node_idx in list_test_nodes if node_idx not in results]
+    if store is not None:
+        print(f"Masks reused from {store.mask_dir}: {len(results)}/{len(list_test_nodes)}")
+    targets = get_targets(model, data, device, args)
+    data = get_explain_data(data)
+    if eval(args.local_inference) and len(list_explain_nodes) > 0:
+        check_local_inference(
+            model,
+            *get_explain_inputs(data, device, args),
+            list_explain_nodes,
+            args.num_gc_layers,
+            num_checks=args.local_inference_checks,
         )
-        end_time = time.time()
-        duration_seconds = end_time - start_time
-        Time.append(duration_seconds)
-        edge_masks.append(edge_mask)
-        node_feat_masks.append(node_feat_mask)
-        t1 = time.time()
-        if t1 - t0 > args.time_limit:
-            print("Time limit reached")
-            break
+    if len(list_explain_nodes) == 0:
+        explain_results = iter_explain_nodes_serial([], model, data, targets, device, args)
+    elif args.explain_workers > 1:
+        explain_results = iter_explain_nodes_parallel(list_explain_nodes, model, data, targets, device, args)
+    else:
+        explain_results = iter_explain_nodes_serial(list_explain_nodes, model, data, targets, device, args)
+    bank = get_warm_start_bank(data, args)
+    elapsed = 0
+    with MaskCheckpointer(store, args.checkpoint_every) as checkpointer:
+        try:
+            t0 = time.time()
+            for node_idx in list_test_nodes:
+                if node_idx in results:
+                    elapsed += results[node_idx][2]
+                else:
+                    results[node_idx] = next(explain_results)
+                    checkpointer.add(node_idx, results[node_idx])
+                    t1 = time.time()
+                    elapsed += t1 - t0
+                    t0 = t1
+                edge_mask, node_feat_mask, duration_seconds = results[node_idx]
+                if bank is not None:
+                    bank.add(edge_mask)
+                Time.append(duration_seconds)
+                edge_masks.append(edge_mask)
+                node_feat_masks.append(node_feat_mask)
+                if elapsed > args.time_limit:
+                    print("Time limit reached")
+                    break
+        finally:
+            explain_results.close()
+            set_warm_start_bank(None)
     args.num_test_final = len(edge_masks)
+    args.convergence_infos = get_convergence_infos(pop_stopped_epochs(), list_test_nodes[: len(Time)], Time)
     return edge_masks, node_feat_masks, Time
-
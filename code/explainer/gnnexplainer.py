@@ -15,8 +15,12 @@ from tqdm import tqdm
 from torch_geometric.data import Data
 from torch_geometric.nn import MessagePassing
 from torch_geometric.utils import k_hop_subgraph, to_networkx
+from utils.cache_utils import cached_k_hop_subgraph
+from explainer.convergence import ConvergenceMonitor
 
 EPS = 1e-15
+# warm-started masks are clamped to [WARM_START_EPS, 1 - WARM_START_EPS] so that their logits remain trainable
+WARM_START_EPS = 0.01
 
 
 class GNNExplainer(torch.nn.Module):
@@ -151,8 +155,8 @@ class GNNExplainer(torch.nn.Module):
     def __subgraph__(self, node_idx, x, edge_index, **kwargs):
         num_nodes, num_edges = x.size(0), edge_index.size(1)
 
-        subset, edge_index, mapping, edge_mask = k_hop_subgraph(
-            node_idx, self.num_hops, edge_index, relabel_nodes=True, num_nodes=num_nodes, flow=self.__flow__()
+        subset, edge_index, mapping, edge_mask = cached_k_hop_subgraph(
+            node_idx, self.num_hops, edge_index, num_nodes=num_nodes, flow=self.__flow__()
         )
 
         x = x[subset]
@@ -458,6 +462,7 @@ class TargetedGNNExplainer(GNNExplainer):
         allow_edge_mask: bool = True,
         allow_node_mask: bool = True,
         log: bool = True,
+        early_stopping: Optional[dict] = None,
         **kwargs,
     ):
         super(TargetedGNNExplainer, self).__init__(
@@ -472,6 +477,22 @@ class TargetedGNNExplainer(GNNExplainer):
             **kwargs,
         )
         self.allow_node_mask = allow_node_mask
+        # keyword arguments of ConvergenceMonitor, the optimization runs for all the epochs if None
+        self.early_stopping = early_stopping
+        # epoch at which the optimization of each node of the last explanation stopped
+        self.stopped_epochs = []
+
+    def __warm_start__(self, edge_mask_init, lo=0, hi=None):
+        """Initialize self.edge_mask[lo:hi] to the logits of the known values of edge_mask_init (NaN if unknown)."""
+        edge_mask_init = edge_mask_init.to(self.edge_mask.device)
+        known = ~torch.isnan(edge_mask_init)
+        init = edge_mask_init[known].clamp(WARM_START_EPS, 1 - WARM_START_EPS)
+        with torch.no_grad():
+            self.edge_mask[lo:hi][known] = torch.log(init / (1 - init))
+
+    def __mask_values__(self):
+        """Values of the learned masks, monitored for convergence."""
+        return torch.cat([self.edge_mask.detach().sigmoid(), self.node_feat_mask.detach().sigmoid().flatten()])
 
     def __loss__(self, node_idx, log_logits, target_class):
         loss = -log_logits[node_idx, target_class]
@@ -571,7 +592,7 @@ class TargetedGNNExplainer(GNNExplainer):
         self.__clear_masks__()
         return node_feat_mask, edge_mask
 
-    def explain_node_with_target(self, node_idx, x, edge_index, edge_weight, target, **kwargs):
+    def explain_node_with_target(self, node_idx, x, edge_index, edge_weight, target, edge_mask_init=None, **kwargs):
         r"""Learns and returns a node feature mask and an edge mask that play a
         crucial role to explain the prediction made by the GNN for node
         :attr:`node_idx`.
@@ -580,6 +601,8 @@ class TargetedGNNExplainer(GNNExplainer):
             node_idx (int): The node to explain.
             x (Tensor): The node feature matrix.
             edge_index (LongTensor): The edge indices.
+            edge_mask_init (Tensor, optional): Initial edge mask values on all the edges of the graph, NaN for
+                the edges initialized randomly.
             **kwargs (optional): Additional arguments passed to the GNN module.
 
         :rtype: (:class:`Tensor`, :class:`Tensor`)
@@ -619,6 +642,8 @@ class TargetedGNNExplainer(GNNExplainer):
 
         self.__set_masks__(x, edge_index)
         self.to(x.device)
+        if edge_mask_init is not None and self.allow_edge_mask:
+            self.__warm_start__(edge_mask_init[hard_edge_mask.to(edge_mask_init.device)])
 
         if self.allow_edge_mask:
             if self.allow_node_mask:
@@ -633,6 +658,8 @@ class TargetedGNNExplainer(GNNExplainer):
             pbar = tqdm(total=self.epochs)
             pbar.set_description(f"Explain node {node_idx}")
 
+        monitor = ConvergenceMonitor(1, **self.early_stopping) if self.early_stopping is not None else None
+        self.stopped_epochs = [self.epochs]
         for epoch in range(1, self.epochs + 1):
             optimizer.zero_grad()
             if self.allow_node_mask:
@@ -655,6 +682,10 @@ class TargetedGNNExplainer(GNNExplainer):
             if self.log:  # pragma: no cover
                 pbar.update(1)
 
+            if monitor is not None and monitor.update(epoch, loss.detach().view(-1), self.__mask_values__())[0]:
+                self.stopped_epochs = [epoch]
+                break
+
         if self.log:  # pragma: no cover
             pbar.close()
 
@@ -679,3 +710,173 @@ class TargetedGNNExplainer(GNNExplainer):
         self.__clear_masks__()
 
         return node_feat_mask, edge_mask
+
+    def explain_nodes_with_target(
+        self, node_indices, x, edge_index, edge_weight, targets, seeds=None, edge_mask_init=None, **kwargs
+    ):
+        r"""Learns the node feature masks and edge masks of several nodes at once.
+
+        The computation subgraphs of the nodes are packed into one disjoint-union graph, with one edge mask
+        segment and one node feature mask per node. The sum of the per-node losses is optimized in a single
+        loop: the subgraphs do not interact and Adam is elementwise, so each node follows the same trajectory
+        as with :meth:`explain_node_with_target`.
+
+        Args:
+            node_indices (list): The nodes to explain.
+            x (Tensor): The node feature matrix.
+            edge_index (LongTensor): The edge indices.
+            edge_weight (Tensor): The edge weights, only used to get the prediction when targets is None.
+            targets (LongTensor, optional): The target class of each node.
+            seeds (list, optional): Seed of the initial masks of each node. With the seed that
+                :meth:`explain_node_with_target` runs with, the masks of a node are initialized identically.
+            edge_mask_init (Tensor, optional): Initial edge mask values on all the edges of the graph, NaN for
+                the edges initialized randomly. The same values initialize the overlapping subgraphs of the nodes.
+
+        :rtype: list of (:class:`Tensor`, :class:`Tensor`)
+        """
+        assert self.feat_mask_type == "feature", "Batched explanations only support one feature mask per node."
+        self.model.eval()
+        self.__clear_masks__()
+
+        num_nodes = x.size(0)
+        num_edges = edge_index.size(1)
+        B = len(node_indices)
+
+        xs, edge_indices, edge_weights, hard_edge_masks, out_indices, edge_segments, node_segments = [], [], [], [], [], [], []
+        offset = 0
+        for b, node_idx in enumerate(node_indices):
+            x_b, edge_index_b, mapping, hard_edge_mask, subset, _ = self.__subgraph__(node_idx, x, edge_index)
+            xs.append(x_b)
+            edge_indices.append(edge_index_b + offset)
+            edge_weights.append(edge_weight[hard_edge_mask])
+            hard_edge_masks.append(hard_edge_mask)
+            out_indices.append(offset + int(mapping[0]))
+            edge_segments.append(torch.full((edge_index_b.size(1),), b, dtype=torch.long, device=x.device))
+            node_segments.append(torch.full((x_b.size(0),), b, dtype=torch.long, device=x.device))
+            offset += x_b.size(0)
+        x = torch.cat(xs)
+        edge_index = torch.cat(edge_indices, dim=1)
+        edge_weight = torch.cat(edge_weights)
+        edge_segment = torch.cat(edge_segments)
+        node_segment = torch.cat(node_segments)
+        out_indices = torch.tensor(out_indices, device=x.device)
+        num_segment_edges = torch.bincount(edge_segment, minlength=B).clamp(min=1)
+
+        if targets is None:
+            with torch.no_grad():
+                out = self.model(x, edge_index, edge_weight=edge_weight)
+                targets = self.__to_log_prob__(out)[out_indices].argmax(dim=-1)
+        targets = torch.as_tensor(targets, device=x.device).view(-1)
+
+        # Same initialization as __set_masks__ on each subgraph, drawn node by node
+        node_feat_masks, edge_masks = [], []
+        for b in range(B):
+            generator = None
+            if seeds is not None:
+                generator = torch.Generator()
+                generator.manual_seed(seeds[b])
+            N_b, E_b = xs[b].size(0), edge_indices[b].size(1)
+            node_feat_masks.append(torch.randn(1, x.size(1), generator=generator) * 0.1)
+            std = torch.nn.init.calculate_gain("relu") * sqrt(2.0 / (2 * N_b))
+            edge_masks.append(torch.randn(E_b, generator=generator) * std)
+        self.node_feat_mask = torch.nn.Parameter(torch.cat(node_feat_masks).to(x.device))
+        self.edge_mask = torch.nn.Parameter(torch.cat(edge_masks).to(x.device))
+        if not self.allow_edge_mask:
+            self.edge_mask.requires_grad_(False)
+            self.edge_mask.fill_(float("inf"))
+        elif edge_mask_init is not None:
+            lo = 0
+            for b in range(B):
+                hi = lo + edge_indices[b].size(1)
+                self.__warm_start__(edge_mask_init[hard_edge_masks[b].to(edge_mask_init.device)], lo, hi)
+                lo = hi
+
+        if self.allow_edge_mask:
+            if self.allow_node_mask:
+                parameters = [self.node_feat_mask, self.edge_mask]
+            else:
+                parameters = [self.edge_mask]
+        else:
+            parameters = [self.node_feat_mask]
+        optimizer = torch.optim.Adam(parameters, lr=self.lr)
+
+        if self.log:  # pragma: no cover
+            pbar = tqdm(total=self.epochs)
+            pbar.set_description(f"Explain {B} nodes")
+
+        # A node that converges keeps the masks of its stopping epoch, as if it was explained alone,
+        # and the loop ends when all the nodes have converged.
+        monitor = ConvergenceMonitor(B, **self.early_stopping) if self.early_stopping is not None else None
+        feat_segment = torch.arange(B, device=x.device).repeat_interleave(self.node_feat_mask.size(1))
+        mask_segment = torch.cat([edge_segment, feat_segment])
+        stopped_masks = None
+        for epoch in range(1, self.epochs + 1):
+            optimizer.zero_grad()
+            if self.allow_node_mask:
+                h = x * self.node_feat_mask.sigmoid()[node_segment]
+            else:
+                h = x
+            out = self.model(x=h, edge_index=edge_index, edge_weight=self.edge_mask.sigmoid())
+            log_logits = self.__to_log_prob__(out)
+            losses = self.__batch_loss__(log_logits, out_indices, targets, edge_segment, num_segment_edges)
+            losses.sum().backward()
+            optimizer.step()
+
+            if self.log:  # pragma: no cover
+                pbar.update(1)
+
+            if monitor is not None:
+                mask_values = self.__mask_values__()
+                newly_converged = monitor.update(epoch, losses.detach(), mask_values, mask_segment)
+                if newly_converged.any():
+                    stopped_masks = mask_values.clone() if stopped_masks is None else stopped_masks
+                    stopped_values = torch.as_tensor(newly_converged, device=x.device)[mask_segment]
+                    stopped_masks[stopped_values] = mask_values[stopped_values]
+                if monitor.converged.all():
+                    break
+
+        if self.log:  # pragma: no cover
+            pbar.close()
+
+        explanations = []
+        node_feat_mask = self.node_feat_mask.detach().sigmoid()
+        edge_mask = self.edge_mask.detach().sigmoid()
+        self.stopped_epochs = [self.epochs] * B
+        if stopped_masks is not None:
+            self.stopped_epochs = [int(e) if e >= 0 else self.epochs for e in monitor.stopped_epochs]
+            converged_values = torch.as_tensor(monitor.converged, device=x.device)[mask_segment]
+            mask_values = torch.where(converged_values, stopped_masks, self.__mask_values__())
+            edge_mask = mask_values[: edge_mask.size(0)]
+            node_feat_mask = mask_values[edge_mask.size(0) :].view_as(node_feat_mask)
+        for b in range(B):
+            if self.allow_edge_mask:
+                full_edge_mask = edge_mask.new_zeros(num_edges)
+                full_edge_mask[hard_edge_masks[b]] = edge_mask[edge_segment == b]
+            else:
+                full_edge_mask = torch.zeros(num_edges)
+                full_edge_mask[hard_edge_masks[b]] = 1
+            explanations.append((node_feat_mask[b], full_edge_mask))
+
+        self.__clear_masks__()
+
+        return explanations
+
+    def __batch_loss__(self, log_logits, out_indices, targets, edge_segment, num_segment_edges):
+        """Per-node losses of explain_nodes_with_target, each equal to __loss__ on the subgraph of the node."""
+        loss = -log_logits[out_indices, targets]
+        B = len(out_indices)
+
+        if self.allow_edge_mask:
+            m = self.edge_mask.sigmoid()
+            loss = loss + self.coeffs["edge_size"] * m.new_zeros(B).index_add(0, edge_segment, m)
+            ent = -m * torch.log(m + EPS) - (1 - m) * torch.log(1 - m + EPS)
+            loss = loss + self.coeffs["edge_ent"] * m.new_zeros(B).index_add(0, edge_segment, ent) / num_segment_edges
+
+        if self.allow_node_mask:
+            m = self.node_feat_mask.sigmoid()
+            node_feat_reduce = getattr(torch, self.coeffs['node_feat_reduction'])
+            loss = loss + self.coeffs['node_feat_size'] * node_feat_reduce(m, dim=1)
+            ent = -m * torch.log(m + EPS) - (1 - m) * torch.log(1 - m + EPS)
+            loss = loss + self.coeffs['node_feat_ent'] * ent.mean(dim=1)
+
+        return loss
@@ -6,6 +6,7 @@ from torch.autograd import Variable
 from torch_geometric.data import Data
 from torch_geometric.utils import to_networkx
 from utils.gen_utils import from_adj_to_edge_index, from_edge_index_to_adj
+from utils.graph_utils import split_batch
 
 from explainer.gnnexplainer import TargetedGNNExplainer
 from explainer.pgmexplainer import Graph_Explainer
@@ -97,6 +98,17 @@ def explain_gradcam_graph(model, x, edge_index, target, device, args, include_ed
     return edge_mask
 
 
+def forward_graph_occlusions(model, x, edge_index, target, occluded_edges):
+    """Output of the model for target on the copies of the graph without each edge of occluded_edges, as one batch."""
+    K, E = len(occluded_edges), edge_index.size(1)
+    keep = torch.ones(K, E, dtype=torch.bool, device=edge_index.device)
+    keep[torch.arange(K, device=edge_index.device), torch.as_tensor(occluded_edges, device=edge_index.device)] = False
+    batch_edge_index = edge_index.unsqueeze(0).expand(K, -1, -1)[keep.unsqueeze(1).expand(K, 2, E)].view(K, 2, E - 1)
+    with torch.no_grad():
+        out = model(x.expand(K, -1, -1), batch_edge_index, per_graph_bn=True)
+    return out[:, target].cpu().numpy()
+
+
 def explain_occlusion_graph(model, x, edge_index, target, device, args, include_edges=None):
     depth_limit = args.num_gc_layers + 1
     data = Data(x=x, edge_index=edge_index)
@@ -105,6 +117,15 @@ def explain_occlusion_graph(model, x, edge_index, target, device, args, include_
         pred_prob = pred_probs[target]
     else:
         pred_prob = 1
+    # the occluded graphs are evaluated one by one by the models that do not accept a batch of graphs
+    if args.occlusion_batch_size > 1 and getattr(model, "batched_input", False):
+        edge_mask = np.zeros(data.num_edges)
+        list_edge_idx = np.arange(data.num_edges)
+        if include_edges is not None:
+            list_edge_idx = list_edge_idx[np.asarray(include_edges.cpu() if torch.is_tensor(include_edges) else include_edges, dtype=bool)]
+        for batch_edge_idx in split_batch(list_edge_idx, args.occlusion_batch_size):
+            edge_mask[batch_edge_idx] = pred_prob - forward_graph_occlusions(model, x, edge_index, target, batch_edge_idx)
+        return edge_mask
     g = to_networkx(data)
     edge_occlusion_mask = np.ones(data.num_edges, dtype=bool)
     edge_mask = np.zeros(data.num_edges)
@@ -155,6 +176,6 @@ def explain_pgmexplainer_graph(model, x, edge_index, target, device, args, inclu
 
 
 def explain_subgraphx_graph(model, x, edge_index, target, device, args, include_edges=None):
-    subgraphx = SubgraphX(model, args.num_classes, device, num_hops=2, explain_graph=True)
+    subgraphx = SubgraphX(model, args.num_classes, device, num_hops=2, explain_graph=True, cache_rewards=args.reward_cache_size > 0, reuse_samples=eval(args.reuse_samples), num_workers=args.subgraphx_workers, deterministic=eval(args.subgraphx_deterministic), batch_rewards=eval(args.subgraphx_batch_rewards), max_batch_nodes=args.subgraphx_max_batch_nodes)
     edge_mask = subgraphx.explain(x, edge_index, max_nodes=args.num_top_edges, label=target)
     return edge_mask
@@ -10,9 +10,13 @@ from torch.autograd import Variable
 from torch_geometric.data import Data
 from torch_geometric.nn import MessagePassing
 from torch_geometric.utils import to_networkx
-from utils.gen_utils import get_subgraph, sample_large_graph
+from utils.cache_utils import cached_k_hop_subgraph, graph_fingerprint
+from utils.gen_utils import LOCAL_INFERENCE_FLOW, get_node_seed, get_subgraph, sample_large_graph
+from utils.graph_utils import get_reverse_edge_index, split_batch
 
+from explainer.convergence import get_early_stopping_params, record_stopped_epoch, record_training_stopped_epoch
 from explainer.gnnexplainer import GNNExplainer, TargetedGNNExplainer
+from explainer.warm_start import get_warm_start_init
 from explainer.gnnlrp import GNN_LRP
 from explainer.graphsvx import LIME, SHAP, GraphLIME, GraphSVX
 from explainer.pgexplainer import PGExplainer
@@ -20,24 +24,38 @@ from explainer.pgmexplainer import Node_Explainer
 from explainer.subgraphx import SubgraphX
 from explainer.zorro import Zorro
 
+# Explainers that modify the x, edge_index or edge_weight tensors they receive. All the other explainers
+# share the tensors of the dataset without copying them (see explainer.genmask.get_explain_inputs).
+INPLACE_EXPLAINERS = []
+
+# Explainers with a batched version explain_<name>_nodes, which explains several nodes at once (see --explain_batch_size).
+BATCH_EXPLAINERS = ["gnnexplainer"]
+
+# Explainers whose edge masks can be initialized from the masks already learned in the run (see --warm_start).
+WARM_START_EXPLAINERS = ["gnnexplainer"]
+
+# (model, graph, num_hops) -> whether the predictions of the nodes only depend on their computation subgraph
+_locality_checks = {}
+
 
 def balance_mask_undirected(edge_mask, edge_index):
+    """Give both directions of each undirected edge (u, v) the max of their mask values.
+
+    Self-loops and edges without a unique reverse edge get 0.
+    """
+    reverse = get_reverse_edge_index(edge_index)
+    u, v = edge_index.cpu().numpy()
     balanced_edge_mask = np.zeros(len(edge_mask))
-    num_edges = edge_index.shape[1]
-    list_edges = edge_index.t().tolist()
-    for i, (u, v) in enumerate(list_edges):
-        if u > v:
-            indices = [idx for idx in range(num_edges) if all(ele in list_edges[idx] for ele in [u, v])]
-            if len(indices) == 2:
-                balanced_edge_mask[indices] = np.max([edge_mask[indices[0]], edge_mask[indices[1]]])
+    valid = (u != v) & (reverse >= 0)
+    edge_mask = np.asarray(edge_mask)
+    balanced_edge_mask[valid] = np.maximum(edge_mask[valid], edge_mask[reverse[valid]])
     return balanced_edge_mask
 
 
 def mask_to_directed(edge_mask, edge_index):
     directed_edge_mask = edge_mask.copy()
-    for i, (u, v) in enumerate(edge_index.t().tolist()):
-        if u > v:
-            directed_edge_mask[i] = 0
+    u, v = edge_index.cpu().numpy()
+    directed_edge_mask[u > v] = 0
     return directed_edge_mask
 
 
@@ -46,6 +64,74 @@ def model_forward_node(x, model, edge_index, edge_weight, node_idx):
     return out[[node_idx]]
 
 
+def get_local_inputs(node_idx, x, edge_index, edge_weight, num_hops):
+    """Restrict (x, edge_index, edge_weight) to the num_hops computation subgraph of node_idx.
+
+    Returns the relabelled inputs, the new index of node_idx, the original indices of the kept nodes
+    and the mask of the kept edges, to scatter the attributions back to the full graph.
+    """
+    subset, sub_edge_index, mapping, edge_mask = cached_k_hop_subgraph(
+        node_idx, num_hops, edge_index, num_nodes=x.size(0), flow=LOCAL_INFERENCE_FLOW
+    )
+    sub_edge_weight = edge_weight[edge_mask] if edge_weight is not None else None
+    return x[subset], sub_edge_index, sub_edge_weight, int(mapping[0]), subset, edge_mask
+
+
+def model_forward_node_local(x, model, edge_index, edge_weight, node_idx, num_hops):
+    """Same output as model_forward_node, computed on the computation subgraph of node_idx only.
+
+    Gradients with respect to x flow back through the indexing, so attributions keep full-graph indices.
+    """
+    x, edge_index, edge_weight, mapping, _, _ = get_local_inputs(node_idx, x, edge_index, edge_weight, num_hops)
+    out = model(x, edge_index, edge_weight=edge_weight)
+    return out[[mapping]]
+
+
+def get_model_forward_node(model, edge_index, edge_weight, node_idx, args):
+    """Return the forward function of the node explainers and its additional arguments."""
+    if eval(args.local_inference):
+        return model_forward_node_local, (model, edge_index, edge_weight, node_idx, args.num_gc_layers)
+    return model_forward_node, (model, edge_index, edge_weight, node_idx)
+
+
+def check_local_inference(model, x, edge_index, edge_weight, list_node_idx, num_hops, num_checks=5, atol=1e-5):
+    """Check that the logits of the nodes are the same on their computation subgraph and on the full graph.
+
+    num_checks nodes evenly spread over list_node_idx are checked (all of them if num_checks <= 0).
+    """
+    list_node_idx = list(list_node_idx)
+    if 0 < num_checks < len(list_node_idx):
+        list_node_idx = [list_node_idx[i] for i in np.linspace(0, len(list_node_idx) - 1, num_checks).astype(int)]
+    with torch.no_grad():
+        for node_idx in list_node_idx:
+            full_out = model_forward_node(x, model, edge_index, edge_weight, node_idx)
+            local_out = model_forward_node_local(x, model, edge_index, edge_weight, node_idx, num_hops)
+            if not torch.allclose(full_out, local_out, atol=atol):
+                raise ValueError(
+                    f"Local inference changes the logits of node {node_idx}: {full_out.tolist()} != {local_out.tolist()}. "
+                    "Check that num_gc_layers matches the model or run with --local_inference False."
+                )
+
+def local_inference_holds(model, x, edge_index, edge_weight, num_hops, list_node_idx=None, num_checks=5):
+    """Whether the predictions of the nodes only depend on their computation subgraph, as the batched paths
+    (occlusion, fidelity) assume.
+
+    The check of check_local_inference runs on list_node_idx, or on nodes spread over the graph if not given.
+    Its result is kept per model, graph and num_hops, so that it runs once per run.
+    """
+    key = (id(model), graph_fingerprint(edge_index, x.size(0)), num_hops)
+    if key not in _locality_checks:
+        if list_node_idx is None:
+            list_node_idx = np.unique(np.linspace(0, x.size(0) - 1, max(num_checks, 1)).astype(int)).tolist()
+        try:
+            check_local_inference(model, x, edge_index, edge_weight, list_node_idx, num_hops, num_checks=num_checks)
+            _locality_checks[key] = True
+        except ValueError as e:
+            print(f"{e} Falling back to full-graph forwards.")
+            _locality_checks[key] = False
+    return _locality_checks[key]
+
+
 def node_attr_to_edge(edge_index, node_mask):
     edge_mask = np.zeros(edge_index.shape[1])
     edge_mask += node_mask[edge_index[0].cpu().numpy()]
@@ -115,10 +201,17 @@ def explain_gradcam_node(model, data, node_idx, x, edge_index, edge_weight, targ
     input_mask = x.clone().requires_grad_(True).to(device)
     layers = get_all_convolution_layers(model, args)
     node_attrs = []
+    forward_func, forward_args = get_model_forward_node(model, edge_index, edge_weight, node_idx, args)
     for layer in layers:
-        layer_gc = LayerGradCam(model_forward_node, layer)
-        node_attr = layer_gc.attribute(input_mask, target=target, additional_forward_args=(model, edge_index, edge_weight, node_idx))
+        layer_gc = LayerGradCam(forward_func, layer)
+        node_attr = layer_gc.attribute(input_mask, target=target, additional_forward_args=forward_args)
         node_attr = node_attr.cpu().detach().numpy().ravel()
+        if eval(args.local_inference):
+            # the layer activations only cover the computation subgraph
+            subset = get_local_inputs(node_idx, x, edge_index, edge_weight, args.num_gc_layers)[4].cpu().numpy()
+            full_node_attr = np.zeros(x.shape[0])
+            full_node_attr[subset] = node_attr
+            node_attr = full_node_attr
         node_attrs.append(node_attr)
     node_attr = np.array(node_attrs).mean(axis=0)
     edge_mask = node_attr_to_edge(edge_index, node_attr)
@@ -126,11 +219,10 @@ def explain_gradcam_node(model, data, node_idx, x, edge_index, edge_weight, targ
 
 
 def explain_sa_node(model, data, node_idx, x, edge_index, edge_weight, target, device, args, include_edges=None):
-    saliency = Saliency(model_forward_node)
+    forward_func, forward_args = get_model_forward_node(model, edge_index, edge_weight, node_idx, args)
+    saliency = Saliency(forward_func)
     input_mask = x.clone().requires_grad_(True).to(device)
-    saliency_mask = saliency.attribute(
-        input_mask, target=target, additional_forward_args=(model, edge_index, edge_weight, node_idx), abs=False
-    )
+    saliency_mask = saliency.attribute(input_mask, target=target, additional_forward_args=forward_args, abs=False)
     # 1 node feature mask per node.
     node_feat_mask = saliency_mask.cpu().numpy()
     node_attr = node_feat_mask.sum(axis=1)
@@ -139,12 +231,13 @@ def explain_sa_node(model, data, node_idx, x, edge_index, edge_weight, target, d
 
 
 def explain_ig_node(model, data, node_idx, x, edge_index, edge_weight, target, device, args, include_edges=None):
-    ig = IntegratedGradients(model_forward_node)
+    forward_func, forward_args = get_model_forward_node(model, edge_index, edge_weight, node_idx, args)
+    ig = IntegratedGradients(forward_func)
     input_mask = x.clone().requires_grad_(True).to(device)
     ig_mask = ig.attribute(
         input_mask,
         target=target,
-        additional_forward_args=(model, edge_index, edge_weight, node_idx),
+        additional_forward_args=forward_args,
         internal_batch_size=input_mask.shape[0],
     )
     node_feat_mask = ig_mask.cpu().detach().numpy()
@@ -153,8 +246,51 @@ def explain_ig_node(model, data, node_idx, x, edge_index, edge_weight, target, d
     return edge_mask, node_feat_mask
 
 
+def forward_edge_occlusions(model, x, edge_index, edge_weight, out_idx, target, occluded_edges):
+    """Output of node out_idx for target on the copies of the graph without each edge of occluded_edges.
+
+    The copies are stacked into one block-diagonal graph and evaluated in a single forward.
+    """
+    K, N, E = len(occluded_edges), x.size(0), edge_index.size(1)
+    keep = torch.ones(K, E, dtype=torch.bool, device=edge_index.device)
+    keep[torch.arange(K, device=edge_index.device), torch.as_tensor(occluded_edges, device=edge_index.device)] = False
+    offsets = torch.arange(K, device=edge_index.device) * N
+    union_edge_index = (edge_index.unsqueeze(0) + offsets.view(K, 1, 1)).permute(1, 0, 2)[:, keep]
+    union_edge_weight = edge_weight.unsqueeze(0).expand(K, E)[keep] if edge_weight is not None else None
+    with torch.no_grad():
+        out = model(x.repeat(K, 1), union_edge_index, edge_weight=union_edge_weight)
+    return out[offsets.to(out.device) + out_idx, target].cpu().numpy()
+
+
+def explain_occlusion_node_batch(model, node_idx, x, edge_index, edge_weight, target, pred_prob, args, include_edges=None):
+    """Batched version of explain_occlusion_node, with args.occlusion_batch_size occluded edges per forward.
+
+    The edges are occluded on the computation subgraph of node_idx, which gives the same output as the full
+    graph. The edges outside of the computation subgraph do not change the output and get pred_prob - base_prob.
+    """
+    _, _, _, subgraph_edge_mask = cached_k_hop_subgraph(node_idx, args.num_gc_layers, edge_index, num_nodes=x.size(0))
+    x_local, edge_index_local, edge_weight_local, out_idx, _, local_edge_mask = get_local_inputs(
+        node_idx, x, edge_index, edge_weight, args.num_gc_layers
+    )
+    with torch.no_grad():
+        base_prob = model(x_local, edge_index_local, edge_weight=edge_weight_local)[out_idx][target].item()
+    occluded = subgraph_edge_mask.cpu().numpy().copy()
+    if include_edges is not None:
+        occluded &= np.asarray(include_edges.cpu() if torch.is_tensor(include_edges) else include_edges, dtype=bool)
+    local_edge_mask = local_edge_mask.cpu().numpy()
+    edge_mask = np.zeros(edge_index.size(1))
+    edge_mask[occluded & ~local_edge_mask] = pred_prob - base_prob
+    list_edge_idx = np.where(occluded & local_edge_mask)[0]
+    local_edge_pos = np.cumsum(local_edge_mask) - 1
+    for batch_edge_idx in split_batch(list_edge_idx, args.occlusion_batch_size):
+        probs = forward_edge_occlusions(
+            model, x_local, edge_index_local, edge_weight_local, out_idx, target, local_edge_pos[batch_edge_idx]
+        )
+        edge_mask[batch_edge_idx] = pred_prob - probs
+    return edge_mask
+
+
 def explain_occlusion_node(model, data, node_idx, x, edge_index, edge_weight, target, device, args, include_edges=None):
-    depth_limit = args.num_gc_layers + 1
     data = Data(x=x, edge_index=edge_index)
     data.edge_weight = edge_weight
     if target is None:
@@ -162,24 +298,41 @@ def explain_occlusion_node(model, data, node_idx, x, edge_index, edge_weight, ta
         pred_prob = pred_probs[target]
     else:
         pred_prob = 1
-    g = to_networkx(data)
-    subgraph_nodes = []
-    for k, v in nx.shortest_path_length(g, target=node_idx).items():
-        if v < depth_limit:
-            subgraph_nodes.append(k)
-    subgraph = g.subgraph(subgraph_nodes)
-    edge_occlusion_mask = np.ones(data.num_edges, dtype=bool)
+    if args.occlusion_batch_size > 1 and local_inference_holds(
+        model, x, edge_index, edge_weight, args.num_gc_layers, num_checks=args.local_inference_checks
+    ):
+        return explain_occlusion_node_batch(model, node_idx, x, edge_index, edge_weight, target, pred_prob, args, include_edges), None
+    # edges between the nodes at distance <= num_gc_layers from node_idx
+    _, _, _, subgraph_edge_mask = cached_k_hop_subgraph(node_idx, args.num_gc_layers, edge_index, num_nodes=x.size(0))
+    subgraph_edge_mask = subgraph_edge_mask.cpu().numpy()
+    if eval(args.local_inference):
+        # occlude the edges of the computation subgraph only; the other edges cannot change the output of node_idx
+        x_forward, edge_index_forward, edge_weight_forward, out_idx, _, local_edge_mask = get_local_inputs(
+            node_idx, x, edge_index, edge_weight, args.num_gc_layers
+        )
+        local_edge_mask = local_edge_mask.cpu().numpy()
+        local_edge_pos = np.cumsum(local_edge_mask) - 1
+        with torch.no_grad():
+            base_prob = model(x_forward, edge_index_forward, edge_weight_forward)[out_idx][target].item()
+    else:
+        x_forward, edge_index_forward, edge_weight_forward, out_idx = data.x, data.edge_index, data.edge_weight, node_idx
+    edge_occlusion_mask = np.ones(edge_index_forward.size(1), dtype=bool)
     edge_mask = np.zeros(data.num_edges)
-    edge_index_numpy = data.edge_index.cpu().numpy()
     for i in range(data.num_edges):
         if include_edges is not None and not include_edges[i].item():
             continue
-        u, v = list(edge_index_numpy[:, i])
-        if (u, v) in subgraph.edges():
-            edge_occlusion_mask[i] = False
-            prob = model(data.x, data.edge_index[:, edge_occlusion_mask], data.edge_weight[edge_occlusion_mask])[node_idx][target].item()
+        if subgraph_edge_mask[i]:
+            if eval(args.local_inference):
+                if not local_edge_mask[i]:
+                    edge_mask[i] = pred_prob - base_prob
+                    continue
+                j = local_edge_pos[i]
+            else:
+                j = i
+            edge_occlusion_mask[j] = False
+            prob = model(x_forward, edge_index_forward[:, edge_occlusion_mask], edge_weight_forward[edge_occlusion_mask])[out_idx][target].item()
             edge_mask[i] = pred_prob - prob
-            edge_occlusion_mask[i] = True
+            edge_occlusion_mask[j] = True
     return edge_mask, None
 
 
@@ -192,31 +345,78 @@ def explain_gnnexplainer_node(model, data, node_idx, x, edge_index, edge_weight,
         edge_size=args.edge_size,
         allow_edge_mask=True,
         allow_node_mask=True,
+        early_stopping=get_early_stopping_params(args),
         device=device
     )
     node_feat_mask, edge_mask = explainer.explain_node_with_target(
-        node_idx, x=x, edge_index=edge_index, edge_weight=edge_weight, target=target
+        node_idx, x=x, edge_index=edge_index, edge_weight=edge_weight, target=target, edge_mask_init=get_warm_start_init()
     )
+    record_stopped_epoch(node_idx, explainer.stopped_epochs[0], explainer.epochs)
     edge_mask = edge_mask.cpu().detach().numpy()
     # 1 node feature mask for all the nodes.
     node_feat_mask = node_feat_mask.cpu().detach().numpy()
     return edge_mask, node_feat_mask
 
 
+def explain_gnnexplainer_nodes(model, data, list_node_idx, x, edge_index, edge_weight, targets, device, args):
+    """Batched version of explain_gnnexplainer_node: explain the nodes of list_node_idx in one optimization."""
+    explainer = TargetedGNNExplainer(
+        model,
+        num_hops=args.num_gc_layers,
+        epochs=1000,
+        edge_ent=args.edge_ent,
+        edge_size=args.edge_size,
+        allow_edge_mask=True,
+        allow_node_mask=True,
+        early_stopping=get_early_stopping_params(args),
+        device=device
+    )
+    seeds = [get_node_seed(args.seed, node_idx) for node_idx in list_node_idx]
+    explanations = explainer.explain_nodes_with_target(
+        list_node_idx, x=x, edge_index=edge_index, edge_weight=edge_weight, targets=targets, seeds=seeds,
+        edge_mask_init=get_warm_start_init()
+    )
+    for node_idx, stopped_epoch in zip(list_node_idx, explainer.stopped_epochs):
+        record_stopped_epoch(node_idx, stopped_epoch, explainer.epochs)
+    return [
+        (edge_mask.cpu().detach().numpy(), node_feat_mask.cpu().detach().numpy())
+        for node_feat_mask, edge_mask in explanations
+    ]
+
+
 def explain_pgmexplainer_node(model, data, node_idx, x, edge_index, edge_weight, target, device, args, include_edges=None):
-    explainer = Node_Explainer(model, edge_index, edge_weight, x, args.num_gc_layers, device=device, print_result=0)
+    if eval(args.local_inference):
+        # the predictions of the neighbours at distance num_gc_layers depend on the nodes at distance 2 * num_gc_layers
+        x_local, edge_index_local, edge_weight_local, node_idx_local, subset, _ = get_local_inputs(
+            node_idx, x, edge_index, edge_weight, 2 * args.num_gc_layers
+        )
+        subset = subset.cpu().numpy()
+    else:
+        x_local, edge_index_local, edge_weight_local, node_idx_local = x, edge_index, edge_weight, node_idx
+    explainer = Node_Explainer(
+        model,
+        edge_index_local,
+        edge_weight_local,
+        x_local,
+        args.num_gc_layers,
+        device=device,
+        print_result=0,
+        max_batch_nodes=args.pgm_max_batch_nodes,
+    )
     explanation = explainer.explain(
-        node_idx, target, num_samples=100, top_node=None, p_threshold=0.05, pred_threshold=0.1
+        node_idx_local, target, num_samples=100, top_node=None, p_threshold=0.05, pred_threshold=0.1
     )
     node_attr = np.zeros(x.shape[0])
     for node, p_value in explanation.items():
+        if eval(args.local_inference):
+            node = subset[node]
         node_attr[node] = 1 - p_value
     edge_mask = node_attr_to_edge(edge_index, node_attr)
     return edge_mask, None
 
 
 def explain_subgraphx_node(model, data, node_idx, x, edge_index, edge_weight, target, device, args, include_edges=None):
-    subgraphx = SubgraphX(model, args.num_classes, device, num_hops=args.num_gc_layers, explain_graph=False, rollout= 20, min_atoms = 4, expand_atoms=14, high2low=True,  sample_num=50, reward_method="mc_shapley", subgraph_building_method="zero_filling", local_radius=4)
+    subgraphx = SubgraphX(model, args.num_classes, device, num_hops=args.num_gc_layers, explain_graph=False, rollout= 20, min_atoms = 4, expand_atoms=14, high2low=True,  sample_num=50, reward_method="mc_shapley", subgraph_building_method="zero_filling", local_radius=4, cache_rewards=args.reward_cache_size > 0, reuse_samples=eval(args.reuse_samples), num_workers=args.subgraphx_workers, deterministic=eval(args.subgraphx_deterministic), batch_rewards=eval(args.subgraphx_batch_rewards), max_batch_nodes=args.subgraphx_max_batch_nodes)
     edge_mask = subgraphx.explain(x, edge_index, edge_weight, max_nodes=args.num_top_edges, label=target, node_idx=node_idx)
     return edge_mask, None
 
@@ -245,7 +445,8 @@ def explain_pgexplainer_node(model, data, node_idx, x, edge_index, edge_weight,
         coef = 3*3
     else:
         coef = 3
-    pgexplainer = PGExplainer(model, in_channels = args.hidden_dim * coef, device = device, num_hops = args.num_gc_layers)
+    pgexplainer = PGExplainer(model, in_channels = args.hidden_dim * coef, device = device, num_hops = args.num_gc_layers,
+                              early_stopping = get_early_stopping_params(args))
     subdir = os.path.join(args.model_save_dir, args.dataset)
     pgexplainer_saving_path = os.path.join(subdir, f'pgexplainer_{args.dataset}.pth')
     if os.path.isfile(pgexplainer_saving_path):
@@ -255,6 +456,7 @@ def explain_pgexplainer_node(model, data, node_idx, x, edge_index, edge_weight,
     else:
         data = sample_large_graph(data)
         pgexplainer.train_explanation_network(data)
+        record_training_stopped_epoch("pgexplainer", pgexplainer.stopped_epoch, pgexplainer.epochs)
         print("Save PGExplainer model...")
         torch.save(pgexplainer.state_dict(), pgexplainer_saving_path)
         state_dict = torch.load(pgexplainer_saving_path)
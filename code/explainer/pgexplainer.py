@@ -18,6 +18,8 @@ from torch_geometric.data import Data
 from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.utils import to_networkx
 from torch_geometric.utils.num_nodes import maybe_num_nodes
+from utils.cache_utils import cached_k_hop_subgraph
+from explainer.convergence import ConvergenceMonitor
 from typing import Tuple, List, Dict, Optional
 
 EPS = 1e-6
@@ -143,7 +145,8 @@ class PGExplainer(nn.Module):
     """
     def __init__(self, model, in_channels: int, device, explain_graph: bool = True, epochs: int = 10,
                  lr: float = 0.005, coff_size: float = 0.05, coff_ent: float = 1.0,
-                 t0: float = 5.0, t1: float = 1.0, sample_bias: float = 0.0, num_hops: Optional[int] = None):
+                 t0: float = 5.0, t1: float = 1.0, sample_bias: float = 0.0, num_hops: Optional[int] = None,
+                 early_stopping: Optional[dict] = None):
         super(PGExplainer, self).__init__()
         self.model = model
         self.device = device
@@ -159,6 +162,8 @@ class PGExplainer(nn.Module):
         self.t0 = t0
         self.t1 = t1
         self.sample_bias = sample_bias
+        self.early_stopping = early_stopping
+        self.stopped_epoch = epochs
 
         self.num_hops = self.update_num_hops(num_hops)
         self.init_bias = 0.0
@@ -269,15 +274,14 @@ class PGExplainer(nn.Module):
 
         """
         num_nodes, num_edges = x.size(0), edge_index.size(1)
-        graph = to_networkx(data=Data(x=x, edge_index=edge_index), to_undirected=True)
 
-        subset, edge_index, _, edge_mask = k_hop_subgraph_with_default_whole_graph(
-            edge_index, node_idx, self.num_hops, relabel_nodes=True,
-            num_nodes=num_nodes, flow=self.__flow__())
-
-        mapping = {int(v): k for k, v in enumerate(subset)}
-        subgraph = graph.subgraph(subset.tolist())
-        nx.relabel_nodes(subgraph, mapping)
+        if node_idx is None:
+            subset, edge_index, _, edge_mask = k_hop_subgraph_with_default_whole_graph(
+                edge_index, node_idx, self.num_hops, relabel_nodes=True,
+                num_nodes=num_nodes, flow=self.__flow__())
+        else:
+            subset, edge_index, _, edge_mask = cached_k_hop_subgraph(
+                node_idx, self.num_hops, edge_index, num_nodes=num_nodes, flow=self.__flow__())
 
         x = x[subset]
         for key, item in kwargs.items():
@@ -407,6 +411,8 @@ class PGExplainer(nn.Module):
 
         # train the mask generator
         duration = 0.0
+        monitor = ConvergenceMonitor(1, **self.early_stopping) if self.early_stopping is not None else None
+        self.stopped_epoch = self.epochs
         for epoch in range(self.epochs):
             loss = 0.0
             optimizer.zero_grad()
@@ -427,6 +433,10 @@ class PGExplainer(nn.Module):
             optimizer.step()
             duration += time.perf_counter() - tic
             print(f'Epoch: {epoch} | Loss: {loss/len(explain_node_index_list)}')
+            if monitor is not None and monitor.update(epoch + 1, [loss / len(explain_node_index_list)])[0]:
+                self.stopped_epoch = epoch + 1
+                print(f"Converged after {self.stopped_epoch}/{self.epochs} epochs")
+                break
         print(f"training time is {duration:.5}s")
 
     def forward(self,
@@ -1,15 +1,17 @@
 import numpy as np
-import pandas as pd
 import torch
-from pgmpy.estimators.CITests import chi_square
 from scipy.special import softmax
-from torch_geometric.utils import k_hop_subgraph
+from utils.cache_utils import cached_k_hop_subgraph
+from utils.gen_utils import LOCAL_INFERENCE_FLOW
+from utils.math_utils import chi_square_tests
 
 ###### Node Classification ######
 
 
 class Node_Explainer:
-    def __init__(self, model, edge_index, edge_weight, X, num_layers, device=None, mode=0, print_result=1):
+    def __init__(
+        self, model, edge_index, edge_weight, X, num_layers, device=None, mode=0, print_result=1, max_batch_nodes=200000
+    ):
         self.model = model
         self.model.eval()
         self.edge_index = edge_index
@@ -19,97 +21,81 @@ class Node_Explainer:
         self.device = device
         self.mode = mode
         self.print_result = print_result
-
-    def perturb_features_on_node(self, feature_matrix, node_idx, random=0, mode=0):
-        # return a random perturbed feature matrix
-        # random = 0 for nothing, 1 for random.
-        # mode = 0 for random 0-1, 1 for scaling with original feature
-
-        X_perturb = feature_matrix
-        if mode == 0:
-            if random == 0:
-                perturb_array = X_perturb[node_idx]
-            elif random == 1:
-                perturb_array = np.random.randint(2, size=X_perturb[node_idx].shape[0])
-            X_perturb[node_idx] = perturb_array
-        elif mode == 1:
-            if random == 0:
-                perturb_array = X_perturb[node_idx]
-            elif random == 1:
-                perturb_array = np.multiply(
-                    X_perturb[node_idx], np.random.uniform(low=0.0, high=2.0, size=X_perturb[node_idx].shape[0])
-                )
-            X_perturb[node_idx] = perturb_array
-        return X_perturb
+        # max number of nodes of the batched forwards on the perturbed graphs
+        self.max_batch_nodes = max_batch_nodes
+
+    def perturb_features(self, X, mapping, samples):
+        """Copies of X [len(samples) x N x F] with the features of the perturbed neighbors replaced.
+
+        samples [len(samples) x num_neighbors] are the Bernoulli latents of the neighbors mapping[j].
+        mode = 0 for random 0-1 features, 1 for scaling the original features by a uniform factor in [0, 2].
+        """
+        B = samples.shape[0]
+        X_samples = X.unsqueeze(0).repeat(B, 1, 1)
+        X_neighbors = X_samples[:, mapping]
+        size = (B, len(mapping), X.size(1))
+        if self.mode == 0:
+            perturb_values = torch.randint(2, size, device=X.device).to(X.dtype)
+        elif self.mode == 1:
+            perturb_values = X_neighbors * torch.empty(size, device=X.device, dtype=X.dtype).uniform_(0.0, 2.0)
+        else:
+            raise NotImplementedError
+        perturbed = torch.as_tensor(samples == 1, device=X.device)
+        X_neighbors[perturbed] = perturb_values[perturbed]
+        X_samples[:, mapping] = X_neighbors
+        return X_samples
+
+    def forward_samples(self, X, edge_index, edge_weight, mapping, samples):
+        """Predictions of the model on the perturbed copies of X given by the latents samples (see perturb_features).
+
+        The perturbed graphs are built and stacked into block-diagonal graphs of at most max_batch_nodes nodes
+        one chunk at a time, so that memory is bounded by max_batch_nodes.
+        """
+        num_samples, N = samples.shape[0], X.size(0)
+        batch_size = max(1, self.max_batch_nodes // max(N, 1))
+        preds = []
+        with torch.no_grad():
+            for start in range(0, num_samples, batch_size):
+                X_batch = self.perturb_features(X, mapping, samples[start : start + batch_size])
+                B = X_batch.size(0)
+                offsets = torch.arange(B, device=edge_index.device).view(B, 1, 1) * N
+                batch_edge_index = (edge_index.unsqueeze(0) + offsets).permute(1, 0, 2).reshape(2, -1)
+                batch_edge_weight = edge_weight.repeat(B) if edge_weight is not None else None
+                pred = self.model(X_batch.reshape(B * N, -1), batch_edge_index, edge_weight=batch_edge_weight)
+                preds.append(pred.view(B, N, -1)[:, mapping].cpu())
+        return torch.cat(preds)
 
     def explain(self, node_idx, target, num_samples=100, top_node=None, p_threshold=0.05, pred_threshold=0.1):
-        neighbors, _, _, _ = k_hop_subgraph(node_idx, self.num_layers, self.edge_index)
+        neighbors, _, _, _ = cached_k_hop_subgraph(node_idx, self.num_layers, self.edge_index)
         neighbors = neighbors.cpu().detach().numpy()
 
         if node_idx not in neighbors:
             neighbors = np.append(neighbors, node_idx)
 
-        pred_torch = self.model(self.X, self.edge_index, self.edge_weight).cpu()
-        soft_pred = np.asarray([softmax(np.asarray(pred_torch[node_].data)) for node_ in range(self.X.shape[0])])
-
-        pred_node = np.asarray(pred_torch[node_idx].data)
-        label_node = np.argmax(pred_node)
-        soft_pred_node = softmax(pred_node)
-
-        Samples = []
-        Pred_Samples = []
-
-        for iteration in range(num_samples):
-
-            X_perturb = self.X.cpu().detach().numpy()
-            sample = []
-            for node in neighbors:
-                seed = np.random.randint(2)
-                if seed == 1:
-                    latent = 1
-                    X_perturb = self.perturb_features_on_node(X_perturb, node, random=seed)
-                else:
-                    latent = 0
-                sample.append(latent)
-
-            X_perturb_torch = torch.tensor(X_perturb, dtype=torch.float).to(self.device)
-            pred_perturb_torch = self.model(X_perturb_torch, self.edge_index, self.edge_weight).cpu()
-            soft_pred_perturb = np.asarray(
-                [softmax(np.asarray(pred_perturb_torch[node_].data)) for node_ in range(self.X.shape[0])]
-            )
-
-            sample_bool = []
-            for node in neighbors:
-                if (soft_pred_perturb[node, target] + pred_threshold) < soft_pred[node, target]:
-                    sample_bool.append(1)
-                else:
-                    sample_bool.append(0)
-
-            Samples.append(sample)
-            Pred_Samples.append(sample_bool)
-
-        Samples = np.asarray(Samples)
-        Pred_Samples = np.asarray(Pred_Samples)
-        Combine_Samples = Samples - Samples
-        for s in range(Samples.shape[0]):
-            Combine_Samples[s] = np.asarray(
-                [Samples[s, i] * 10 + Pred_Samples[s, i] + 1 for i in range(Samples.shape[1])]
-            )
-
-        data_pgm = pd.DataFrame(Combine_Samples)
-        data_pgm = data_pgm.rename(columns={0: "A", 1: "B"})  # Trick to use chi_square test on first two data columns
-        ind_ori_to_sub = dict(zip(neighbors, list(data_pgm.columns)))
-
-        p_values = []
-        for node in neighbors:
-            if node == node_idx:
-                p = 0  # p<0.05 => we are confident that we can reject the null hypothesis (i.e. the prediction is the same after perturbing the neighbouring node
-                # => this neighbour has no influence on the prediction - should not be in the explanation)
-            else:
-                chi2, p, _ = chi_square(
-                    ind_ori_to_sub[node], ind_ori_to_sub[node_idx], [], data_pgm, boolean=False, significance_level=0.05
-                )
-            p_values.append(p)
+        # The predictions of the neighbors only depend on their computation subgraphs
+        subset, edge_index, mapping, edge_mask = cached_k_hop_subgraph(
+            neighbors.tolist(), self.num_layers, self.edge_index, num_nodes=self.X.size(0), flow=LOCAL_INFERENCE_FLOW
+        )
+        X = self.X[subset].to(self.device)
+        edge_weight = self.edge_weight[edge_mask] if self.edge_weight is not None else None
+
+        with torch.no_grad():
+            pred_torch = self.model(X, edge_index, edge_weight=edge_weight).cpu()
+        soft_pred = torch.softmax(pred_torch[mapping], dim=-1).numpy()
+
+        # One Bernoulli latent variable per (sample, neighbor): the features of the perturbed neighbors are
+        # replaced as given by self.mode (see perturb_features).
+        Samples = np.random.randint(2, size=(num_samples, len(neighbors)))
+        pred_perturb_torch = self.forward_samples(X, edge_index, edge_weight, mapping, Samples)
+        soft_pred_perturb = torch.softmax(pred_perturb_torch, dim=-1).numpy()
+        Pred_Samples = ((soft_pred_perturb[:, :, target] + pred_threshold) < soft_pred[:, target]).astype(int)
+        Combine_Samples = Samples * 10 + Pred_Samples + 1
+
+        _, p_values, _ = chi_square_tests(Combine_Samples, int(np.where(neighbors == node_idx)[0][0]))
+        # p<0.05 => we are confident that we can reject the null hypothesis (i.e. the prediction is the same after perturbing the neighbouring node
+        # => this neighbour has no influence on the prediction - should not be in the explanation)
+        p_values[neighbors == node_idx] = 0
+        p_values = p_values.tolist()
 
         pgm_stats = dict(zip(neighbors, p_values))
         return pgm_stats
@@ -241,15 +227,9 @@ class Graph_Explainer:
             int(num_samples / 2), range(num_nodes), percentage, p_threshold, pred_threshold
         )
 
-        data = pd.DataFrame(Samples)
-
-        p_values = []
-        candidate_nodes = []
-
         target = num_nodes  # The entry for the graph classification data is at "num_nodes"
-        for node in range(num_nodes):
-            chi2, p, _ = chi_square(node, target, [], data, boolean=False, significance_level=0.05)
-            p_values.append(p)
+        _, p_values, _ = chi_square_tests(Samples, target)
+        p_values = list(p_values[:num_nodes])
 
         number_candidates = top_node
         candidate_nodes = np.argpartition(p_values, number_candidates)[0:number_candidates]
@@ -258,17 +238,10 @@ class Graph_Explainer:
         Samples = self.batch_perturb_features_on_node(
             num_samples, candidate_nodes, percentage, p_threshold, pred_threshold
         )
-        data = pd.DataFrame(Samples)
-
-        p_values = []
-        dependent_nodes = []
-
         target = num_nodes
-        for node in range(num_nodes):
-            chi2, p, _ = chi_square(node, target, [], data, boolean=False, significance_level=0.05)
-            p_values.append(p)
-            if p < p_threshold:
-                dependent_nodes.append(node)
+        _, p_values, _ = chi_square_tests(Samples, target)
+        p_values = list(p_values[:num_nodes])
+        dependent_nodes = [node for node in range(num_nodes) if p_values[node] < p_threshold]
 
         top_p = np.min((top_node, num_nodes - 1))
         ind_top_p = np.argpartition(p_values, top_p)[0:top_p]
@@ -1,11 +1,17 @@
-import copy
 import torch
 import numpy as np
 from scipy.special import comb
+from scipy.stats import norm
 from itertools import combinations
 import torch.nn.functional as F
-from torch_geometric.utils import to_networkx
 from torch_geometric.data import Data, Batch, Dataset, DataLoader
+from utils.cache_utils import LRUCache, graph_fingerprint
+
+# graph -> edge_index and batch vector of copies of the graph. The entries live on the device of the graph and
+# are rarely reused once the search of a node is over: only a few are kept
+batched_structure_cache = LRUCache(max_size=4)
+# (graph, coalition, local radius) -> local region of the coalition
+local_region_cache = LRUCache(max_size=4096)
 
 
 def GnnNetsGC2valueFunc(gnnNets, target_class):
@@ -68,8 +74,20 @@ class MarginalSubgraphDataset(Dataset):
         return exclude_data, include_data
 
 
-def marginal_contribution(data: Data, exclude_mask: np.array, include_mask: np.array, value_func, subgraph_build_func):
-    """Calculate the marginal value for each pair. Here exclude_mask and include_mask are node mask."""
+def marginal_contribution(
+    data: Data, exclude_mask: np.array, include_mask: np.array, value_func, subgraph_build_func, value_memo=None
+):
+    """Calculate the marginal value for each pair. Here exclude_mask and include_mask are node mask.
+
+    If value_memo (dict) is given, the value of each distinct node mask is computed once and kept in value_memo,
+    so that the coalitions scored with the same memo share the values of their common masks.
+    """
+    if value_memo is not None:
+        return memoized_marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func, value_memo)
+    if subgraph_build_func is graph_build_zero_filling:
+        values = mask_values(data, np.concatenate([exclude_mask, include_mask], axis=0), value_func, subgraph_build_func)
+        num_pairs = exclude_mask.shape[0]
+        return values[num_pairs:] - values[:num_pairs]
     marginal_subgraph_dataset = MarginalSubgraphDataset(data, exclude_mask, include_mask, subgraph_build_func)
     dataloader = DataLoader(marginal_subgraph_dataset, batch_size=256, shuffle=False, num_workers=0)
 
@@ -85,6 +103,156 @@ def marginal_contribution(data: Data, exclude_mask: np.array, include_mask: np.a
     return marginal_contributions
 
 
+def batched_structure(edge_index, num_nodes, batch_size):
+    """edge_index and batch vector of batch_size disjoint copies of a graph.
+
+    The structure of the largest batch size met is cached per graph, and the smaller batches (e.g. the last
+    chunk of mask_values) are slices of it.
+    """
+    key = graph_fingerprint(edge_index, num_nodes)
+    structure = batched_structure_cache.get(key)
+    if structure is None or structure[2] < batch_size:
+        offsets = torch.arange(batch_size, device=edge_index.device) * num_nodes
+        batch_edge_index = (edge_index.unsqueeze(0) + offsets.view(-1, 1, 1)).permute(1, 0, 2).reshape(2, -1)
+        batch = torch.arange(batch_size, device=edge_index.device).repeat_interleave(num_nodes)
+        structure = (batch_edge_index, batch, batch_size)
+        batched_structure_cache.put(key, structure)
+    batch_edge_index, batch, _ = structure
+    return batch_edge_index[:, : batch_size * edge_index.size(1)], batch[: batch_size * num_nodes]
+
+def zero_filling_batch(data: Data, masks: torch.Tensor) -> Data:
+    """Batch of the zero-filled subgraphs of the node masks (S x N): the features are masked per sample and the
+    edge_index is shared by all the samples."""
+    num_samples, num_nodes = masks.shape
+    x = (masks.unsqueeze(-1) * data.x.unsqueeze(0)).reshape(num_samples * num_nodes, -1)
+    edge_index, batch = batched_structure(data.edge_index, num_nodes, num_samples)
+    return Data(x=x, edge_index=edge_index, batch=batch)
+
+
+def mask_values(data: Data, masks: np.array, value_func, subgraph_build_func, batch_size=256):
+    """Value of the subgraph built from each node mask of masks."""
+    masks = torch.tensor(masks).type(torch.float32).to(data.x.device)
+    values = []
+    for batch_masks in masks.split(batch_size):
+        if subgraph_build_func is graph_build_zero_filling:
+            values.append(value_func(zero_filling_batch(data, batch_masks)))
+            continue
+        data_list = []
+        for mask in batch_masks:
+            ret_x, ret_edge_index = subgraph_build_func(data.x, data.edge_index, mask)
+            data_list.append(Data(x=ret_x, edge_index=ret_edge_index))
+        values.append(value_func(Batch.from_data_list(data_list)))
+    return torch.cat(values, dim=0)
+
+
+def memoized_marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func, value_memo):
+    masks = np.concatenate([exclude_mask, include_mask], axis=0) > 0
+    keys = [np.packbits(mask).tobytes() for mask in masks]
+    new_masks = {}
+    for key, mask in zip(keys, masks):
+        if key not in value_memo and key not in new_masks:
+            new_masks[key] = mask
+    if new_masks:
+        values = mask_values(data, np.stack(list(new_masks.values())), value_func, subgraph_build_func)
+        value_memo.update(zip(new_masks.keys(), values.cpu().tolist()))
+    values = torch.tensor([value_memo[key] for key in keys])
+    num_pairs = exclude_mask.shape[0]
+    return values[num_pairs:] - values[:num_pairs]
+
+
+def reduce_marginal_contributions(marginal_contributions, coeffs=None):
+    """Reward of a coalition: the mean of its marginal contributions, or their sum weighted by coeffs."""
+    if coeffs is None:
+        return marginal_contributions.mean().item()
+    return (marginal_contributions.squeeze().cpu() * coeffs).sum().item()
+
+
+def batched_rewards(
+    coalitions, data: Data, value_func, mask_func, subgraph_building_method="zero_filling", child_kwargs=None,
+    max_batch_nodes=200000,
+):
+    """Rewards of several coalitions of the same graph, with all their masks evaluated together.
+
+    The exclude and include masks of every coalition (mask_func, e.g. mc_shapley_masks) are stacked, the distinct
+    masks are evaluated in block-diagonal batches of at most max_batch_nodes nodes, and the marginal
+    contributions of each coalition are reduced as in its reward function.
+
+    Args:
+        child_kwargs (list, optional): additional keyword arguments of mask_func for each coalition.
+    """
+    subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    pair_masks, pair_coeffs = [], []
+    for i, coalition in enumerate(coalitions):
+        kwargs = child_kwargs[i] if child_kwargs is not None else {}
+        exclude_mask, include_mask, coeffs = mask_func(coalition, data, **kwargs)
+        pair_masks.append((exclude_mask, include_mask))
+        pair_coeffs.append(coeffs)
+    if not pair_masks:
+        return []
+
+    masks = np.concatenate([mask for pair in pair_masks for mask in pair], axis=0) > 0
+    unique_masks, inverse = np.unique(np.packbits(masks, axis=1), axis=0, return_inverse=True)
+    unique_masks = np.unpackbits(unique_masks, axis=1, count=masks.shape[1]).astype(bool)
+    batch_size = max(1, max_batch_nodes // max(data.num_nodes, 1))
+    values = mask_values(data, unique_masks, value_func, subgraph_build_func, batch_size=batch_size)
+    values = values.cpu()[torch.from_numpy(inverse.reshape(-1))]
+
+    rewards, offset = [], 0
+    for (exclude_mask, include_mask), coeffs in zip(pair_masks, pair_coeffs):
+        num_pairs = exclude_mask.shape[0]
+        exclude_values = values[offset : offset + num_pairs]
+        include_values = values[offset + num_pairs : offset + 2 * num_pairs]
+        rewards.append(reduce_marginal_contributions(include_values - exclude_values, coeffs))
+        offset += 2 * num_pairs
+    return rewards
+
+
+def sample_player_ranks(sample_num, num_nodes):
+    """Random ranks of the nodes and of the coalition placeholder (last column) for sample_num permutations.
+
+    A node comes before the placeholder in a permutation iff its rank is lower. The permutations restricted to
+    the players of any coalition are uniform, so the same ranks can be shared by the coalitions of several
+    children of the search tree (common random numbers).
+    """
+    return np.random.rand(sample_num, num_nodes + 1)
+
+
+def ranked_exclude_mask(sample_ranks, players, exclude_mask):
+    """Set the players that come before the coalition placeholder in each permutation of sample_ranks."""
+    exclude_mask = np.tile(exclude_mask, (sample_ranks.shape[0], 1))
+    exclude_mask[:, players] = sample_ranks[:, players] < sample_ranks[:, -1:]
+    return exclude_mask
+
+
+def sampled_exclude_mask(sample_num, players, exclude_mask):
+    """Set the players that come before the coalition placeholder in sample_num random permutations.
+
+    The permutations of the players and of the placeholder (last column) are drawn at once as random ranks.
+    """
+    ranks = np.random.rand(sample_num, len(players) + 1)
+    exclude_mask = np.tile(exclude_mask, (sample_num, 1))
+    exclude_mask[:, players] = ranks[:, :-1] < ranks[:, -1:]
+    return exclude_mask
+
+
+def get_local_region(coalition, data: Data, local_radius):
+    """Nodes reached from the coalition in at most local_radius - 1 hops along the edges of data.
+
+    The regions are cached per graph, coalition and radius.
+    """
+    key = (graph_fingerprint(data.edge_index, data.num_nodes), tuple(sorted(coalition)), local_radius)
+    local_region = local_region_cache.get(key)
+    if local_region is None:
+        row, col = data.edge_index.cpu().numpy()
+        region_mask = np.zeros(data.num_nodes, dtype=bool)
+        region_mask[coalition] = True
+        for k in range(local_radius - 1):
+            region_mask[col[region_mask[row]]] = True
+        local_region = np.nonzero(region_mask)[0]
+        local_region_cache.put(key, local_region)
+    return local_region
+
+
 def graph_build_zero_filling(X, edge_index, node_mask: np.array):
     """subgraph building through masking the unselected nodes with zero features"""
     ret_X = X * node_mask.unsqueeze(1)
@@ -100,19 +268,10 @@ def graph_build_split(X, edge_index, node_mask: np.array):
     return ret_X, ret_edge_index
 
 
-def l_shapley(coalition: list, data: Data, local_radius: int, value_func: str, subgraph_building_method="zero_filling"):
-    """shapley value where players are local neighbor nodes"""
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
-    subgraph_build_func = get_graph_build_func(subgraph_building_method)
-
-    local_region = copy.copy(coalition)
-    for k in range(local_radius - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
+def l_shapley_masks(coalition: list, data: Data, local_radius: int):
+    """Exclude and include masks of l_shapley, with the weight of each pair."""
+    num_nodes = data.num_nodes
+    local_region = get_local_region(coalition, data, local_radius)
 
     set_exclude_masks = []
     set_include_masks = []
@@ -139,45 +298,188 @@ def l_shapley(coalition: list, data: Data, local_radius: int, value_func: str, s
     p = num_players
     S = num_player_in_set
     coeffs = torch.tensor(1.0 / comb(p, S) / (p - S + 1e-6))
+    return exclude_mask, include_mask, coeffs
 
-    marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
 
-    l_shapley_value = (marginal_contributions.squeeze().cpu() * coeffs).sum().item()
+def l_shapley(
+    coalition: list,
+    data: Data,
+    local_radius: int,
+    value_func: str,
+    subgraph_building_method="zero_filling",
+    max_exact_players=12,
+    tolerance=1e-3,
+    confidence=0.95,
+    samples_per_size=8,
+    max_evaluations=20000,
+    stats=None,
+    rng=None,
+):
+    """shapley value where players are local neighbor nodes
+
+    The value is computed exactly by enumerating the subsets of the local neighbors if there are at most
+    max_exact_players players, else it is estimated by stratified sampling (see stratified_l_shapley).
+    If stats (dict) is given, the number of model evaluations spent on the coalition is added to
+    stats["num_evaluations"], and stats["exact"] and stats["half_width"] describe the last estimate.
+    The subsets are sampled with rng (numpy Generator) if given, else with np.random.
+    """
+    subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    local_region = get_local_region(coalition, data, local_radius)
+    nodes_around = np.setdiff1d(local_region, coalition)
+    exact = len(nodes_around) + 1 <= max_exact_players
+    if exact:
+        exclude_mask, include_mask, coeffs = l_shapley_masks(coalition, data, local_radius)
+        marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
+        l_shapley_value = reduce_marginal_contributions(marginal_contributions, coeffs)
+        num_evaluations, half_width = 2 * exclude_mask.shape[0], 0.0
+    else:
+        l_shapley_value, half_width, num_evaluations = stratified_l_shapley(
+            coalition,
+            data,
+            local_region,
+            nodes_around,
+            value_func,
+            subgraph_build_func,
+            tolerance=tolerance,
+            confidence=confidence,
+            samples_per_size=samples_per_size,
+            max_evaluations=max_evaluations,
+            rng=rng,
+        )
+    if stats is not None:
+        stats["num_evaluations"] = stats.get("num_evaluations", 0) + num_evaluations
+        stats["exact"] = exact
+        stats["half_width"] = half_width
     return l_shapley_value
 
 
+def stratified_l_shapley(
+    coalition,
+    data: Data,
+    local_region,
+    nodes_around,
+    value_func,
+    subgraph_build_func,
+    tolerance=1e-3,
+    confidence=0.95,
+    samples_per_size=8,
+    max_evaluations=20000,
+    rng=None,
+):
+    """Stratified sampling estimate of l_shapley, stratified by the number of neighbors joining the coalition.
+
+    The shapley value is the average over the sizes 0..n of the mean marginal contribution of the subsets of
+    that size of the n neighbors. Each round samples random subsets of every size, the sizes with few subsets
+    being enumerated once and for all, and allocates the samples of the next round in proportion to the
+    standard deviation of each size (Neyman allocation). The sampling stops when the half-width of the
+    confidence interval of the estimate is at most tolerance, or after max_evaluations model evaluations.
+
+    Returns:
+        the estimate, the half-width of its confidence interval and the number of model evaluations.
+    """
+    num_around = len(nodes_around)
+    num_sizes = num_around + 1
+    base_mask = np.ones(data.num_nodes)
+    base_mask[local_region] = 0.0
+    z = norm.ppf(0.5 + confidence / 2)
+    rng = np.random if rng is None else rng
+
+    contributions = [np.zeros(0) for _ in range(num_sizes)]
+    exhausted = np.zeros(num_sizes, dtype=bool)
+    allocation = np.full(num_sizes, samples_per_size)
+    num_evaluations = 0
+    while True:
+        exclude_masks, round_sizes = [], []
+        for size in np.nonzero(allocation > 0)[0]:
+            if comb(num_around, size, exact=True) <= samples_per_size:
+                subsets = np.array(list(combinations(range(num_around), size)), dtype=np.int64).reshape(-1, size)
+                exhausted[size] = True
+            else:
+                subsets = rng.random((allocation[size], num_around)).argsort(axis=1)[:, :size]
+            exclude_mask = np.tile(base_mask, (len(subsets), 1))
+            exclude_mask[np.arange(len(subsets))[:, None], nodes_around[subsets]] = 1.0
+            exclude_masks.append(exclude_mask)
+            round_sizes.append(np.full(len(subsets), size))
+        exclude_mask = np.concatenate(exclude_masks, axis=0)
+        include_mask = exclude_mask.copy()
+        include_mask[:, coalition] = 1.0
+        round_contributions = (
+            marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func).cpu().numpy()
+        )
+        num_evaluations += 2 * exclude_mask.shape[0]
+        round_sizes = np.concatenate(round_sizes)
+        for size in np.unique(round_sizes):
+            contributions[size] = np.concatenate([contributions[size], round_contributions[round_sizes == size]])
+
+        counts = np.array([len(values) for values in contributions])
+        means = np.array([values.mean() for values in contributions])
+        stds = np.array([values.std(ddof=1) if len(values) > 1 else 0.0 for values in contributions])
+        stds[exhausted] = 0.0
+        estimate = means.mean()
+        half_width = z * np.sqrt((stds**2 / counts).sum()) / num_sizes
+        if half_width <= tolerance or num_evaluations >= max_evaluations or stds.sum() == 0:
+            return estimate, half_width, num_evaluations
+
+        budget = max(1, min(samples_per_size * num_sizes, (max_evaluations - num_evaluations) // 2))
+        allocation = np.ceil(budget * stds / stds.sum()).astype(np.int64)
+
+
+def mc_shapley_masks(coalition: list, data: Data, sample_num=1000, sample_ranks=None):
+    """Exclude and include masks of mc_shapley. The permutations are drawn from sample_ranks if given."""
+    num_nodes = data.num_nodes
+    players = np.setdiff1d(np.arange(num_nodes), coalition)
+    if sample_ranks is not None:
+        exclude_mask = ranked_exclude_mask(sample_ranks, players, np.zeros(num_nodes))
+    else:
+        exclude_mask = sampled_exclude_mask(sample_num, players, np.zeros(num_nodes))
+    include_mask = exclude_mask.copy()
+    include_mask[:, coalition] = 1.0
+    return exclude_mask, include_mask, None
+
+
 def mc_shapley(
-    coalition: list, data: Data, value_func: str, subgraph_building_method="zero_filling", sample_num=1000
+    coalition: list,
+    data: Data,
+    value_func: str,
+    subgraph_building_method="zero_filling",
+    sample_num=1000,
+    sample_ranks=None,
+    value_memo=None,
 ) -> float:
-    """monte carlo sampling approximation of the shapley value"""
+    """monte carlo sampling approximation of the shapley value
+
+    The permutations are drawn from sample_ranks (see sample_player_ranks) if given.
+    """
     subset_build_func = get_graph_build_func(subgraph_building_method)
+    exclude_mask, include_mask, _ = mc_shapley_masks(coalition, data, sample_num=sample_num, sample_ranks=sample_ranks)
+    marginal_contributions = marginal_contribution(
+        data, exclude_mask, include_mask, value_func, subset_build_func, value_memo=value_memo
+    )
+    mc_shapley_value = marginal_contributions.mean().item()
 
-    num_nodes = data.num_nodes
-    node_indices = np.arange(num_nodes)
-    coalition_placeholder = num_nodes
-    set_exclude_masks = []
-    set_include_masks = []
+    return mc_shapley_value
 
-    for example_idx in range(sample_num):
-        subset_nodes_from = [node for node in node_indices if node not in coalition]
-        random_nodes_permutation = np.array(subset_nodes_from + [coalition_placeholder])
-        random_nodes_permutation = np.random.permutation(random_nodes_permutation)
-        split_idx = np.where(random_nodes_permutation == coalition_placeholder)[0][0]
-        selected_nodes = random_nodes_permutation[:split_idx]
-        set_exclude_mask = np.zeros(num_nodes)
-        set_exclude_mask[selected_nodes] = 1.0
-        set_include_mask = set_exclude_mask.copy()
-        set_include_mask[coalition] = 1.0
 
-        set_exclude_masks.append(set_exclude_mask)
-        set_include_masks.append(set_include_mask)
+def mc_l_shapley_masks(coalition: list, data: Data, local_radius: int, node_idx: int = -1, sample_num=1000, sample_ranks=None):
+    """Exclude and include masks of mc_l_shapley, and of NC_mc_l_shapley if node_idx is given.
 
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subset_build_func)
-    mc_shapley_value = marginal_contributions.mean().item()
+    The permutations are drawn from sample_ranks if given.
+    """
+    num_nodes = data.num_nodes
+    local_region = get_local_region(coalition, data, local_radius)
 
-    return mc_shapley_value
+    players = np.setdiff1d(local_region, coalition)
+    set_exclude_mask = np.ones(num_nodes)
+    set_exclude_mask[local_region] = 0.0
+    if sample_ranks is not None:
+        exclude_mask = ranked_exclude_mask(sample_ranks, players, set_exclude_mask)
+    else:
+        exclude_mask = sampled_exclude_mask(sample_num, players, set_exclude_mask)
+    if node_idx != -1:
+        exclude_mask[:, node_idx] = 1.0
+    include_mask = exclude_mask.copy()
+    include_mask[:, coalition] = 1.0  # include the node_idx
+    return exclude_mask, include_mask, None
 
 
 def mc_l_shapley(
@@ -187,41 +489,20 @@ def mc_l_shapley(
     value_func: str,
     subgraph_building_method="zero_filling",
     sample_num=1000,
+    sample_ranks=None,
+    value_memo=None,
 ) -> float:
-    """monte carlo sampling approximation of the l_shapley value"""
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
-    subgraph_build_func = get_graph_build_func(subgraph_building_method)
-
-    local_region = copy.copy(coalition)
-    for k in range(local_radius - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
+    """monte carlo sampling approximation of the l_shapley value
 
-    coalition_placeholder = num_nodes
-    set_exclude_masks = []
-    set_include_masks = []
-    for example_idx in range(sample_num):
-        subset_nodes_from = [node for node in local_region if node not in coalition]
-        random_nodes_permutation = np.array(subset_nodes_from + [coalition_placeholder])
-        random_nodes_permutation = np.random.permutation(random_nodes_permutation)
-        split_idx = np.where(random_nodes_permutation == coalition_placeholder)[0][0]
-        selected_nodes = random_nodes_permutation[:split_idx]
-        set_exclude_mask = np.ones(num_nodes)
-        set_exclude_mask[local_region] = 0.0
-        set_exclude_mask[selected_nodes] = 1.0
-        set_include_mask = set_exclude_mask.copy()
-        set_include_mask[coalition] = 1.0
-
-        set_exclude_masks.append(set_exclude_mask)
-        set_include_masks.append(set_include_mask)
-
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
+    The permutations are drawn from sample_ranks (see sample_player_ranks) if given.
+    """
+    subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    exclude_mask, include_mask, _ = mc_l_shapley_masks(
+        coalition, data, local_radius, sample_num=sample_num, sample_ranks=sample_ranks
+    )
+    marginal_contributions = marginal_contribution(
+        data, exclude_mask, include_mask, value_func, subgraph_build_func, value_memo=value_memo
+    )
 
     mc_l_shapley_value = (marginal_contributions).mean().item()
     return mc_l_shapley_value
@@ -249,43 +530,20 @@ def NC_mc_l_shapley(
     node_idx: int = -1,
     subgraph_building_method="zero_filling",
     sample_num=1000,
+    sample_ranks=None,
+    value_memo=None,
 ) -> float:
-    """monte carlo approximation of l_shapley where the target node is kept in both subgraph"""
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
-    subgraph_build_func = get_graph_build_func(subgraph_building_method)
-
-    local_region = copy.copy(coalition)
-    for k in range(local_radius - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
+    """monte carlo approximation of l_shapley where the target node is kept in both subgraph
 
-    coalition_placeholder = num_nodes
-    set_exclude_masks = []
-    set_include_masks = []
-    for example_idx in range(sample_num):
-        subset_nodes_from = [node for node in local_region if node not in coalition]
-        random_nodes_permutation = np.array(subset_nodes_from + [coalition_placeholder])
-        random_nodes_permutation = np.random.permutation(random_nodes_permutation)
-        split_idx = np.where(random_nodes_permutation == coalition_placeholder)[0][0]
-        selected_nodes = random_nodes_permutation[:split_idx]
-        set_exclude_mask = np.ones(num_nodes)
-        set_exclude_mask[local_region] = 0.0
-        set_exclude_mask[selected_nodes] = 1.0
-        if node_idx != -1:
-            set_exclude_mask[node_idx] = 1.0
-        set_include_mask = set_exclude_mask.copy()
-        set_include_mask[coalition] = 1.0  # include the node_idx
-
-        set_exclude_masks.append(set_exclude_mask)
-        set_include_masks.append(set_include_mask)
-
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
+    The permutations are drawn from sample_ranks (see sample_player_ranks) if given.
+    """
+    subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    exclude_mask, include_mask, _ = mc_l_shapley_masks(
+        coalition, data, local_radius, node_idx=node_idx, sample_num=sample_num, sample_ranks=sample_ranks
+    )
+    marginal_contributions = marginal_contribution(
+        data, exclude_mask, include_mask, value_func, subgraph_build_func, value_memo=value_memo
+    )
 
     mc_l_shapley_value = (marginal_contributions).mean().item()
     return mc_l_shapley_value
@@ -1,28 +1,81 @@
 import copy
 import math
 import os
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import Callable, Dict, List, Optional, Tuple
 
 import networkx as nx
+import numpy as np
 import torch
 from torch import Tensor
 from torch_geometric.data import Batch, Data
 from torch_geometric.nn.conv import MessagePassing
-from torch_geometric.utils import k_hop_subgraph, remove_self_loops, to_networkx
+from torch_geometric.utils import remove_self_loops, to_networkx
+from utils.cache_utils import LRUCache, cached_k_hop_subgraph, graph_fingerprint, tensor_fingerprint
+from utils.graph_utils import CSRGraph
 
 from explainer.shapley import (
     GnnNetsGC2valueFunc,
     GnnNetsNC2valueFunc,
     NC_mc_l_shapley,
+    batched_rewards,
     gnn_score,
     l_shapley,
     mc_l_shapley,
+    mc_l_shapley_masks,
     mc_shapley,
+    mc_shapley_masks,
+    sample_player_ranks,
     sparsity,
 )
 
+# (model, graph, target node, class, coalition bitset, reward config) -> reward of the coalition, shared by the
+# searches of the process so that the coalitions met again in later rollouts or explanations are scored once
+reward_cache = LRUCache(max_size=100000)
+
+# reward methods whose permutations can be shared between the children of a tree node
+SAMPLING_REWARDS = ["mc_shapley", "mc_l_shapley", "nc_mc_l_shapley"]
+# reward methods that adapt their number of model evaluations to the coalition, drawing their samples from an
+# rng argument and reporting the evaluations spent in a stats argument
+ADAPTIVE_REWARDS = ["l_shapley"]
+
+
+class RewardEvaluations(object):
+    """Model evaluations spent by the adaptive rewards on the coalitions scored in this process."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.num_coalitions = 0
+        self.num_exact = 0
+        self.num_evaluations = 0
+
+    def add(self, stats):
+        self.num_coalitions += 1
+        self.num_exact += int(stats.get("exact", False))
+        self.num_evaluations += stats.get("num_evaluations", 0)
+
+    def merge(self, info):
+        """Add the counts of info (see info) collected in another process."""
+        self.num_coalitions += info["reward_coalitions"]
+        self.num_exact += info["reward_exact_coalitions"]
+        self.num_evaluations += info["reward_evaluations"]
+
+    def info(self):
+        return {
+            "reward_coalitions": self.num_coalitions,
+            "reward_exact_coalitions": self.num_exact,
+            "reward_evaluations": self.num_evaluations,
+            "reward_evaluations_per_coalition": self.num_evaluations / self.num_coalitions
+            if self.num_coalitions > 0
+            else 0.0,
+        }
+
+
+reward_evaluations = RewardEvaluations()
+
 
 def find_closest_node_result(results, max_nodes):
     """return the highest reward tree_node with its subgraph is smaller than max_nodes"""
@@ -79,14 +132,99 @@ def reward_func(
         raise NotImplementedError
 
 
-def compute_scores(score_func, children):
-    results = []
-    for child in children:
-        if child.P == 0:
-            score = score_func(child.coalition, child.data)
+def batch_reward_func(
+    reward_method,
+    value_func,
+    node_idx=None,
+    local_radius=4,
+    sample_num=100,
+    subgraph_building_method="zero_filling",
+    max_batch_nodes=200000,
+):
+    """Batched version of reward_func: scores a list of coalitions at once, None if the method has none.
+
+    l_shapley has none, since it chooses between exact enumeration and adaptive sampling per coalition.
+    """
+    reward_method = reward_method.lower()
+    if reward_method == "mc_shapley":
+        mask_func = partial(mc_shapley_masks, sample_num=sample_num)
+    elif reward_method == "mc_l_shapley":
+        mask_func = partial(mc_l_shapley_masks, local_radius=local_radius, sample_num=sample_num)
+    elif reward_method == "nc_mc_l_shapley":
+        assert node_idx is not None, " Wrong node idx input "
+        mask_func = partial(mc_l_shapley_masks, local_radius=local_radius, node_idx=node_idx, sample_num=sample_num)
+    else:
+        return None
+    return partial(
+        batched_rewards,
+        value_func=value_func,
+        mask_func=mask_func,
+        subgraph_building_method=subgraph_building_method,
+        max_batch_nodes=max_batch_nodes,
+    )
+
+
+def coalition_key(coalition):
+    """Hashable key of a coalition: the same set of nodes always gives the same key."""
+    return tuple(sorted(coalition))
+
+
+def compute_scores(
+    score_func, children, cache_keys=None, executor=None, child_kwargs=None, batch_score_func=None, num_chunks=1,
+    collect_stats=False, **score_kwargs
+):
+    """Rewards of the children: P if already scored, else the cached reward or the reward computed by score_func.
+
+    If batch_score_func (see batch_reward_func) is given, the missing rewards are computed together by it, in
+    num_chunks chunks. The missing rewards, or chunks, are computed concurrently on executor
+    (concurrent.futures.Executor) if given. child_kwargs gives additional keyword arguments of score_func for
+    each child. With collect_stats, score_func fills a stats dict per child (see l_shapley), which is added to
+    reward_evaluations.
+    """
+    results = [child.P for child in children]
+    pending = []
+    for i, child in enumerate(children):
+        if child.P != 0:
+            continue
+        score = reward_cache.get(cache_keys[i]) if cache_keys is not None else None
+        if score is not None:
+            results[i] = score
+            continue
+        kwargs = dict(score_kwargs, **child_kwargs[i]) if child_kwargs is not None else score_kwargs
+        if collect_stats:
+            kwargs = dict(kwargs, stats={})
+        pending.append((i, kwargs))
+
+    if batch_score_func is not None:
+        chunk_size = max(1, math.ceil(len(pending) / num_chunks))
+        chunks = [pending[start : start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        chunk_args = [
+            ([children[i].coalition for i, _ in chunk], children[0].data, [kwargs for _, kwargs in chunk])
+            for chunk in chunks
+        ]
+        if executor is None:
+            chunk_scores = [
+                batch_score_func(coalitions, data, child_kwargs=kwargs) for coalitions, data, kwargs in chunk_args
+            ]
         else:
-            score = child.P
-        results.append(score)
+            futures = [
+                executor.submit(batch_score_func, coalitions, data, child_kwargs=kwargs)
+                for coalitions, data, kwargs in chunk_args
+            ]
+            chunk_scores = [future.result() for future in futures]
+        scores = [score for chunk in chunk_scores for score in chunk]
+    elif executor is None:
+        scores = [score_func(children[i].coalition, children[i].data, **kwargs) for i, kwargs in pending]
+    else:
+        futures = [executor.submit(score_func, children[i].coalition, children[i].data, **kwargs) for i, kwargs in pending]
+        scores = [future.result() for future in futures]
+
+    for (i, kwargs), score in zip(pending, scores):
+        results[i] = score
+        if collect_stats:
+            reward_evaluations.add(kwargs["stats"])
+        if cache_keys is not None:
+            reward_cache.put(cache_keys[i], score)
     return results
 
 
@@ -159,6 +297,15 @@ class MCTS(object):
         high2low (:obj:`bool`): Whether to expand children tree node from high degree nodes to low degree nodes.
         node_idx (:obj:`int`): The target node index to extract the neighborhood.
         score_func (:obj:`Callable`): The reward function for tree node, such as mc_shapely and mc_l_shapely.
+        batch_score_func (:obj:`Callable`, :obj:`None`): The batched version of :obj:`score_func`
+          (see :obj:`batch_reward_func`), scoring all the children of the expanded tree nodes at once.
+        reward_key (:obj:`tuple`, :obj:`None`): Prefix of the keys of the rewards in :obj:`reward_cache`,
+          identifying the model, graph, target and reward configuration. Rewards are not cached if :obj:`None`.
+        sample_num (:obj:`int`, :obj:`None`): The number of permutations of the Monte Carlo reward methods,
+          :obj:`None` for the other reward methods.
+        reuse_samples (:obj:`bool`): Whether the children of a tree node are scored with the same :obj:`sample_num`
+          permutations (common random numbers) and share the values of their common subgraphs.
+        adaptive_reward (:obj:`bool`): Whether :obj:`score_func` is one of the :obj:`ADAPTIVE_REWARDS`.
     """
 
     def __init__(
@@ -173,7 +320,12 @@ class MCTS(object):
         high2low: bool = False,
         node_idx: int = None,
         score_func: Callable = None,
+        batch_score_func: Optional[Callable] = None,
         device="cpu",
+        reward_key: Optional[Tuple] = None,
+        sample_num: Optional[int] = None,
+        reuse_samples: bool = False,
+        adaptive_reward: bool = False,
     ):
 
         self.X = X
@@ -186,12 +338,20 @@ class MCTS(object):
         self.data = Batch.from_data_list([self.data])
         self.num_nodes = self.graph.number_of_nodes()
         self.score_func = score_func
+        self.batch_score_func = batch_score_func
+        self.num_workers = 1
         self.n_rollout = n_rollout
         self.min_atoms = min_atoms
         self.c_puct = c_puct
         self.expand_atoms = expand_atoms
         self.high2low = high2low
         self.new_node_idx = None
+        self.reward_key = reward_key
+        self.sample_num = sample_num
+        self.reuse_samples = reuse_samples and sample_num is not None
+        self.adaptive_reward = adaptive_reward
+        # node index in X of each node of self.graph
+        self.global_nodes = np.arange(self.num_nodes)
 
         self.ori_data = copy.copy(self.data)
         # extract the sub-graph and change the node indices.
@@ -211,22 +371,32 @@ class MCTS(object):
             self.num_nodes = self.graph.number_of_nodes()
 
             self.subset = subset
+            self.global_nodes = subset.cpu().numpy()
 
+        # array copy of self.graph for the pruning of the coalitions in mcts_rollout
+        self.csr_graph = CSRGraph.from_networkx(self.graph)
         self.root_coalition = sorted([node for node in range(self.num_nodes)])
         self.MCTSNodeClass = partial(
             MCTSNode, data=self.data, ori_graph=self.graph, c_puct=self.c_puct, device=self.device
         )
         self.root = self.MCTSNodeClass(self.root_coalition)
-        self.state_map = {str(self.root.coalition): self.root}
+        # coalition_key(coalition) -> MCTSNode of every explored state
+        self.state_map = {coalition_key(self.root.coalition): self.root}
 
-    def set_score_func(self, score_func):
+    def set_score_func(self, score_func, batch_score_func=None):
         self.score_func = score_func
+        self.batch_score_func = batch_score_func
+
+    def reward_cache_key(self, coalition):
+        global_mask = np.zeros(self.X.size(0), dtype=bool)
+        global_mask[self.global_nodes[coalition]] = True
+        return self.reward_key + (np.packbits(global_mask).tobytes(),)
 
     @staticmethod
     def __subgraph__(node_idx, x, edge_index, num_hops, **kwargs):
         num_nodes, num_edges = x.size(0), edge_index.size(1)
-        subset, edge_index, _, edge_mask = k_hop_subgraph(
-            node_idx, num_hops, edge_index, relabel_nodes=True, num_nodes=num_nodes, flow="source_to_target"
+        subset, edge_index, _, edge_mask = cached_k_hop_subgraph(
+            node_idx, num_hops, edge_index, num_nodes=num_nodes, flow="source_to_target"
         )
 
         x = x[subset]
@@ -239,82 +409,174 @@ class MCTS(object):
 
         return x, edge_index, subset, edge_mask, kwargs
 
-    def mcts_rollout(self, tree_node):
+    def expand(self, tree_node):
+        """Create the children of tree_node, without scoring them."""
         cur_graph_coalition = tree_node.coalition
-        if len(cur_graph_coalition) <= self.min_atoms:
-            return tree_node.P
+        coalition_mask = self.csr_graph.node_mask(cur_graph_coalition)
+        coalition_nodes = np.nonzero(coalition_mask)[0]
+        node_degree_list = zip(coalition_nodes.tolist(), self.csr_graph.degree(coalition_mask)[coalition_nodes])
+        node_degree_list = sorted(node_degree_list, key=lambda x: x[1], reverse=self.high2low)
+        all_nodes = [x[0] for x in node_degree_list]
+
+        if self.new_node_idx:
+            expand_nodes = [node for node in all_nodes if node != self.new_node_idx]
+        else:
+            expand_nodes = all_nodes
 
-        # Expand if this node has never been visited
-        if len(tree_node.children) == 0:
-            node_degree_list = list(self.graph.subgraph(cur_graph_coalition).degree)
-            node_degree_list = sorted(node_degree_list, key=lambda x: x[1], reverse=self.high2low)
-            all_nodes = [x[0] for x in node_degree_list]
+        if len(all_nodes) > self.expand_atoms:
+            expand_nodes = expand_nodes[: self.expand_atoms]
+
+        # for each node, pruning it and get the remaining sub-graph
+        # here we check the resulting sub-graphs and only keep the largest one
+        subgraph_masks = np.tile(coalition_mask, (len(expand_nodes), 1))
+        subgraph_masks[np.arange(len(expand_nodes)), expand_nodes] = False
+        labels = self.csr_graph.connected_components(subgraph_masks)
 
+        children_keys = set()
+        for component_labels in labels:
             if self.new_node_idx:
-                expand_nodes = [node for node in all_nodes if node != self.new_node_idx]
+                main_sub = np.nonzero(component_labels == component_labels[self.new_node_idx])[0]
             else:
-                expand_nodes = all_nodes
+                main_sub = self.csr_graph.largest_component(component_labels)
 
-            if len(all_nodes) > self.expand_atoms:
-                expand_nodes = expand_nodes[: self.expand_atoms]
+            new_graph_coalition = main_sub.tolist()
+            new_key = coalition_key(new_graph_coalition)
 
-            for each_node in expand_nodes:
-                # for each node, pruning it and get the remaining sub-graph
-                # here we check the resulting sub-graphs and only keep the largest one
-                subgraph_coalition = [node for node in all_nodes if node != each_node]
+            # check the state map and merge the same sub-graph
+            new_node = self.state_map.get(new_key)
+            if new_node is None:
+                new_node = self.MCTSNodeClass(new_graph_coalition)
+                self.state_map[new_key] = new_node
 
-                subgraphs = [
-                    self.graph.subgraph(c) for c in nx.connected_components(self.graph.subgraph(subgraph_coalition))
-                ]
+            if new_key not in children_keys:
+                children_keys.add(new_key)
+                tree_node.children.append(new_node)
 
-                if self.new_node_idx:
-                    for sub in subgraphs:
-                        if self.new_node_idx in list(sub.nodes()):
-                            main_sub = sub
-                else:
-                    main_sub = subgraphs[0]
-                    for sub in subgraphs:
-                        if sub.number_of_nodes() > main_sub.number_of_nodes():
-                            main_sub = sub
-
-                new_graph_coalition = sorted(list(main_sub.nodes()))
-
-                # check the state map and merge the same sub-graph
-                find_same = False
-                for old_graph_node in self.state_map.values():
-                    if Counter(old_graph_node.coalition) == Counter(new_graph_coalition):
-                        new_node = old_graph_node
-                        find_same = True
-
-                if not find_same:
-                    new_node = self.MCTSNodeClass(new_graph_coalition)
-                    self.state_map[str(new_graph_coalition)] = new_node
-
-                find_same_child = False
-                for cur_child in tree_node.children:
-                    if Counter(cur_child.coalition) == Counter(new_graph_coalition):
-                        find_same_child = True
-
-                if not find_same_child:
-                    tree_node.children.append(new_node)
-            scores = compute_scores(self.score_func, tree_node.children)
-            for child, score in zip(tree_node.children, scores):
-                child.P = score
+    def score_children(self, expanded_nodes, executor=None, deterministic=True):
+        """Score the children of the tree nodes expanded_nodes.
 
+        If executor is given, the rewards are computed concurrently. In deterministic mode the permutations of
+        the Monte Carlo rewards are then drawn beforehand in a fixed order, so that the rewards do not depend
+        on the scheduling of the workers.
+        """
+        children, child_kwargs, scored = [], [], set()
+        for tree_node in expanded_nodes:
+            node_kwargs = {}
+            if self.reuse_samples:
+                # the batched scoring shares the values of the common masks of all the children by itself
+                node_kwargs = {"sample_ranks": sample_player_ranks(self.sample_num, self.num_nodes)}
+                if self.batch_score_func is None:
+                    node_kwargs["value_memo"] = {}
+            for child in tree_node.children:
+                if id(child) in scored:
+                    continue
+                scored.add(id(child))
+                kwargs = node_kwargs
+                if executor is not None and deterministic and self.sample_num is not None and not self.reuse_samples:
+                    kwargs = {"sample_ranks": sample_player_ranks(self.sample_num, self.num_nodes)}
+                if self.adaptive_reward:
+                    # seeded in the main thread, in the order of the children
+                    kwargs = dict(kwargs, rng=np.random.default_rng(np.random.randint(2**31 - 1)))
+                children.append(child)
+                child_kwargs.append(kwargs)
+
+        cache_keys = None
+        if self.reward_key is not None:
+            cache_keys = [self.reward_cache_key(child.coalition) for child in children]
+        scores = compute_scores(
+            self.score_func,
+            children,
+            cache_keys=cache_keys,
+            executor=executor,
+            child_kwargs=child_kwargs,
+            batch_score_func=self.batch_score_func,
+            num_chunks=self.num_workers if executor is not None else 1,
+            collect_stats=self.adaptive_reward,
+        )
+        for child, score in zip(children, scores):
+            child.P = score
+
+    def select_child(self, tree_node):
         sum_count = sum([c.N for c in tree_node.children])
-        selected_node = max(tree_node.children, key=lambda x: x.Q() + x.U(sum_count))
+        return max(tree_node.children, key=lambda x: x.Q() + x.U(sum_count))
+
+    def mcts_rollout(self, tree_node):
+        cur_graph_coalition = tree_node.coalition
+        if len(cur_graph_coalition) <= self.min_atoms:
+            return tree_node.P
+
+        # Expand if this node has never been visited
+        if len(tree_node.children) == 0:
+            self.expand(tree_node)
+            self.score_children([tree_node])
+
+        selected_node = self.select_child(tree_node)
         v = self.mcts_rollout(selected_node)
         selected_node.W += v
         selected_node.N += 1
         return v
 
-    def mcts(self, verbose=True):
+    def parallel_mcts_rollouts(self, num_rollouts, executor, deterministic=True):
+        """Run num_rollouts rollouts concurrently, descending the tree together one level at a time.
+
+        At each level, the tree nodes reached for the first time are expanded and all their children are scored
+        on the executor. A rollout counts its visit of a tree node as soon as it selects it (virtual loss), so
+        that the next rollouts prefer other branches; the value is added when the rollout reaches a leaf.
+        """
+        paths = [[self.root] for _ in range(num_rollouts)]
+        values = [None] * num_rollouts
+        active = list(range(num_rollouts))
+        while active:
+            expanded_nodes, expanded_ids = [], set()
+            for rollout_idx in active:
+                tree_node = paths[rollout_idx][-1]
+                if len(tree_node.coalition) > self.min_atoms and len(tree_node.children) == 0:
+                    if id(tree_node) not in expanded_ids:
+                        expanded_ids.add(id(tree_node))
+                        self.expand(tree_node)
+                        expanded_nodes.append(tree_node)
+            if expanded_nodes:
+                self.score_children(expanded_nodes, executor=executor, deterministic=deterministic)
+
+            next_active = []
+            for rollout_idx in active:
+                tree_node = paths[rollout_idx][-1]
+                if len(tree_node.coalition) <= self.min_atoms:
+                    values[rollout_idx] = tree_node.P
+                    continue
+                selected_node = self.select_child(tree_node)
+                selected_node.N += 1
+                paths[rollout_idx].append(selected_node)
+                next_active.append(rollout_idx)
+            active = next_active
+
+        for path, v in zip(paths, values):
+            for tree_node in path[1:]:
+                tree_node.W += v
+
+    def mcts(self, verbose=True, num_workers=1, deterministic=True):
+        """Build the search tree with n_rollout rollouts.
+
+        With num_workers > 1, the rollouts run by groups of num_workers (see parallel_mcts_rollouts) and the
+        rewards are computed by a pool of num_workers threads.
+        """
         if verbose:
             print(f"The nodes in graph is {self.graph.number_of_nodes()}")
-        for rollout_idx in range(self.n_rollout):
-            self.mcts_rollout(self.root)
-            if verbose:
-                print(f"At the {rollout_idx} rollout, {len(self.state_map)} states that have been explored.")
+        self.num_workers = num_workers
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for rollout_idx in range(0, self.n_rollout, num_workers):
+                    num_rollouts = min(num_workers, self.n_rollout - rollout_idx)
+                    self.parallel_mcts_rollouts(num_rollouts, executor, deterministic=deterministic)
+                    if verbose:
+                        print(
+                            f"At the {rollout_idx + num_rollouts - 1} rollout, {len(self.state_map)} states that have been explored."
+                        )
+        else:
+            for rollout_idx in range(self.n_rollout):
+                self.mcts_rollout(self.root)
+                if verbose:
+                    print(f"At the {rollout_idx} rollout, {len(self.state_map)} states that have been explored.")
 
         explanations = [node for _, node in self.state_map.items()]
         explanations = sorted(explanations, key=lambda x: x.P, reverse=True)
@@ -348,6 +610,18 @@ class SubgraphX(object):
         save_dir(:obj:`str`, :obj:`None`): Root directory to save the explanation results (default: :obj:`None`)
         filename(:obj:`str`): The filename of results
         vis(:obj:`bool`): Whether to show the visualization (default: :obj:`True`)
+        cache_rewards(:obj:`bool`): Whether to keep the rewards of the coalitions in :obj:`reward_cache` and reuse
+          them across rollouts and explanations (default: :obj:`True`)
+        reuse_samples(:obj:`bool`): Whether to score the children of a tree node with the same sampled
+          permutations, for the Monte Carlo reward methods (default: :obj:`False`)
+        num_workers(:obj:`int`): Number of rollouts run concurrently, with their rewards computed by a pool of
+          threads (default: :obj:`1`)
+        deterministic(:obj:`bool`): Whether the concurrent rollouts give reproducible results, independent of
+          the scheduling of the threads (default: :obj:`True`)
+        batch_rewards(:obj:`bool`): Whether to score all the children of an expanded tree node together, with
+          the masks of all their samples evaluated in shared batched forwards (default: :obj:`True`)
+        max_batch_nodes(:obj:`int`): Max number of nodes of the batched forwards of the rewards
+          (default: :obj:`200000`)
     Example:
         >>> # For graph classification task
         >>> subgraphx = SubgraphX(model=model, num_classes=2)
@@ -374,6 +648,12 @@ class SubgraphX(object):
         save_dir: Optional[str] = None,
         filename: str = "example",
         vis: bool = True,
+        cache_rewards: bool = True,
+        reuse_samples: bool = False,
+        num_workers: int = 1,
+        deterministic: bool = True,
+        batch_rewards: bool = True,
+        max_batch_nodes: int = 200000,
     ):
 
         self.model = model
@@ -397,6 +677,14 @@ class SubgraphX(object):
         self.sample_num = sample_num
         self.reward_method = reward_method
         self.subgraph_building_method = subgraph_building_method
+        self.cache_rewards = cache_rewards
+        self.reuse_samples = reuse_samples and reward_method.lower() in SAMPLING_REWARDS
+        self.batch_rewards = batch_rewards
+        self.max_batch_nodes = max_batch_nodes
+
+        # parallel search
+        self.num_workers = num_workers
+        self.deterministic = deterministic
 
         # saving and visualization
         self.vis = vis
@@ -428,7 +716,48 @@ class SubgraphX(object):
             subgraph_building_method=self.subgraph_building_method,
         )
 
-    def get_mcts_class(self, x, edge_index, node_idx: int = None, score_func: Callable = None):
+    def get_batch_reward_func(self, value_func, node_idx=None):
+        if not self.batch_rewards:
+            return None
+        if self.explain_graph:
+            node_idx = None
+        return batch_reward_func(
+            reward_method=self.reward_method,
+            value_func=value_func,
+            node_idx=node_idx,
+            local_radius=self.local_radius,
+            sample_num=self.sample_num,
+            subgraph_building_method=self.subgraph_building_method,
+            max_batch_nodes=self.max_batch_nodes,
+        )
+
+    def get_reward_key(self, x, edge_index, label, node_idx=None):
+        """Prefix of the reward cache keys of the coalitions of one explanation."""
+        if not self.cache_rewards:
+            return None
+        return (
+            tuple(tensor_fingerprint(param) for param in self.model.parameters()),
+            tensor_fingerprint(x),
+            graph_fingerprint(edge_index, x.size(0)),
+            None if self.explain_graph else int(node_idx),
+            int(label),
+            self.num_hops,
+            self.reward_method.lower(),
+            self.local_radius,
+            self.sample_num,
+            self.subgraph_building_method,
+            self.reuse_samples,
+        )
+
+    def get_mcts_class(
+        self,
+        x,
+        edge_index,
+        node_idx: int = None,
+        score_func: Callable = None,
+        label=None,
+        batch_score_func: Optional[Callable] = None,
+    ):
         if self.explain_graph:
             node_idx = None
         else:
@@ -439,6 +768,11 @@ class SubgraphX(object):
             node_idx=node_idx,
             device=self.device,
             score_func=score_func,
+            batch_score_func=batch_score_func,
+            reward_key=self.get_reward_key(x, edge_index, label, node_idx=node_idx) if label is not None else None,
+            sample_num=self.sample_num if self.reward_method.lower() in SAMPLING_REWARDS else None,
+            reuse_samples=self.reuse_samples,
+            adaptive_reward=self.reward_method.lower() in ADAPTIVE_REWARDS,
             num_hops=self.num_hops,
             n_rollout=self.rollout,
             min_atoms=self.min_atoms,
@@ -491,8 +825,16 @@ class SubgraphX(object):
             if not saved_MCTSInfo_list:
                 value_func = GnnNetsGC2valueFunc(self.model, target_class=label)
                 payoff_func = self.get_reward_func(value_func)
-                self.mcts_state_map = self.get_mcts_class(x, edge_index, score_func=payoff_func)
-                results = self.mcts_state_map.mcts(verbose=self.verbose)
+                self.mcts_state_map = self.get_mcts_class(
+                    x,
+                    edge_index,
+                    score_func=payoff_func,
+                    label=label,
+                    batch_score_func=self.get_batch_reward_func(value_func),
+                )
+                results = self.mcts_state_map.mcts(
+                    verbose=self.verbose, num_workers=self.num_workers, deterministic=self.deterministic
+                )
 
             # l sharply score
             value_func = GnnNetsGC2valueFunc(self.model, target_class=label)
@@ -502,14 +844,17 @@ class SubgraphX(object):
             if saved_MCTSInfo_list:
                 results = self.read_from_MCTSInfo_list(saved_MCTSInfo_list)
 
-            self.mcts_state_map = self.get_mcts_class(x, edge_index, node_idx=node_idx)
+            self.mcts_state_map = self.get_mcts_class(x, edge_index, node_idx=node_idx, label=label)
             self.new_node_idx = self.mcts_state_map.new_node_idx
             # mcts will extract the subgraph and relabel the nodes
             value_func = GnnNetsNC2valueFunc(self.model, node_idx=self.mcts_state_map.new_node_idx, target_class=label)
             if not saved_MCTSInfo_list:
                 payoff_func = self.get_reward_func(value_func, node_idx=self.mcts_state_map.new_node_idx)
-                self.mcts_state_map.set_score_func(payoff_func)
-                results = self.mcts_state_map.mcts(verbose=self.verbose)
+                batch_payoff_func = self.get_batch_reward_func(value_func, node_idx=self.mcts_state_map.new_node_idx)
+                self.mcts_state_map.set_score_func(payoff_func, batch_score_func=batch_payoff_func)
+                results = self.mcts_state_map.mcts(
+                    verbose=self.verbose, num_workers=self.num_workers, deterministic=self.deterministic
+                )
 
             self.mapping_inv = self.mcts_state_map.mapping_inv
             tree_node_x = find_closest_node_result(results, max_nodes=max_nodes)
@@ -0,0 +1,50 @@
+""" warm_start.py
+    Warm start of the edge masks of GNNExplainer from the masks already learned in the run.
+"""
+import numpy as np
+import torch
+
+# Bank of the run, set by explainer.genmask.compute_edge_masks_nc when --warm_start is True
+_warm_start_bank = None
+
+
+class EdgeMaskBank(object):
+    """Running average of the edge masks learned on each edge of the graph.
+
+    The edges of the computation subgraph of a node get a non-zero mask from GNNExplainer (the sigmoid of the
+    learned logits), the other edges are zero. `add` therefore averages each edge over the masks in which it is
+    non-zero, and `get_init` returns NaN for the edges that were never part of an explained subgraph.
+    """
+
+    def __init__(self, num_edges):
+        self.mask_sum = np.zeros(num_edges)
+        self.mask_count = np.zeros(num_edges, dtype=np.int64)
+
+    def add(self, edge_mask):
+        if edge_mask is None:
+            return
+        edge_mask = np.asarray(edge_mask, dtype=np.float64).reshape(-1)
+        if edge_mask.shape[0] != self.mask_sum.shape[0]:
+            return
+        learned = edge_mask > 0
+        self.mask_sum[learned] += edge_mask[learned]
+        self.mask_count[learned] += 1
+
+    def get_init(self):
+        """Average mask of each edge, NaN for the edges without a learned mask."""
+        init = np.full(self.mask_sum.shape[0], np.nan)
+        known = self.mask_count > 0
+        init[known] = self.mask_sum[known] / self.mask_count[known]
+        return torch.from_numpy(init).float()
+
+
+def set_warm_start_bank(bank):
+    global _warm_start_bank
+    _warm_start_bank = bank
+
+
+def get_warm_start_init():
+    """Initial edge mask values of the next explanation, or None if warm start is disabled."""
+    if _warm_start_bank is None:
+        return None
+    return _warm_start_bank.get_init()
@@ -17,6 +17,12 @@ from torch.nn.modules.module import Module
 #### Kipf and Welling GCN #####
 
 
+def build_sparse_adj(edge_index, edge_weight, num_nodes):
+    """Coalesced sparse [N x N] adjacency where row edge_index[0] aggregates the messages of column edge_index[1]."""
+    shape = torch.Size((num_nodes, num_nodes))
+    return torch.sparse_coo_tensor(edge_index, edge_weight, shape).coalesce()
+
+
 class GraphConvolution(Module):
     """
     Simple GCN layer, similar to https://arxiv.org/abs/1609.02907
@@ -40,13 +46,15 @@ class GraphConvolution(Module):
         if self.bias is not None:
             self.bias.data.uniform_(-stdv, stdv)
 
-    def forward(self, input, edge_index, edge_weight=None):
-        if edge_weight is None:
-            edge_weight = torch.ones(edge_index.size(1), device=self.device, requires_grad=True)
+    def forward(self, input, edge_index, edge_weight=None, adj=None):
+        """`adj` is the sparse adjacency built from (edge_index, edge_weight) by `build_sparse_adj`.
+        It is built here if not given."""
+        if adj is None:
+            if edge_weight is None:
+                edge_weight = torch.ones(edge_index.size(1), device=self.device, requires_grad=True)
+            adj = build_sparse_adj(edge_index, edge_weight, len(input))
         self.weight = self.weight.to(self.device)
         support = torch.mm(input, self.weight)
-        shape = torch.Size((len(input), len(input)))
-        adj = torch.sparse.FloatTensor(edge_index, edge_weight, shape)
         output = torch.sparse.mm(adj, support)
         if self.bias is not None:
             return output + self.bias
@@ -58,8 +66,18 @@ class GraphConvolution(Module):
 
 
 class GCN(nn.Module):
-    def __init__(self, num_node_features, hidden_dim, num_classes, dropout, num_layers=2, device=None):
+    """Kipf and Welling GCN.
+
+    The sparse adjacency is built once per forward and shared by all the layers. With `cached=True`, it is also
+    reused across forward calls as long as the same edge_index and edge_weight tensors are passed unmodified.
+    The cache is bypassed when edge_weight requires gradients, e.g. when an explainer optimizes an edge mask.
+    """
+
+    def __init__(self, num_node_features, hidden_dim, num_classes, dropout, num_layers=2, device=None, cached=False):
         super().__init__()
+        self.cached = cached
+        # (edge_index, edge_weight, their versions, num_nodes, adj) of the last adjacency built with the cache
+        self._cached_adj = None
         self.num_node_features, self.num_classes, self.num_layers, self.hidden_dim, self.dropout = (
             num_node_features,
             num_classes,
@@ -75,18 +93,39 @@ class GCN(nn.Module):
             current_dim = hidden_dim
         self.layers.append(GraphConvolution(current_dim, self.num_classes, device=self.device))
 
+    def get_adj(self, edge_index, edge_weight, num_nodes):
+        if not self.cached or edge_weight.requires_grad:
+            return build_sparse_adj(edge_index, edge_weight, num_nodes)
+        versions = (edge_index._version, edge_weight._version)
+        if self._cached_adj is not None:
+            cached_edge_index, cached_edge_weight, cached_versions, cached_num_nodes, adj = self._cached_adj
+            # the cache holds references to the key tensors, so their ids cannot be reused by other tensors
+            if (
+                cached_edge_index is edge_index
+                and cached_edge_weight is edge_weight
+                and cached_versions == versions
+                and cached_num_nodes == num_nodes
+            ):
+                return adj
+        adj = build_sparse_adj(edge_index, edge_weight, num_nodes)
+        self._cached_adj = (edge_index, edge_weight, versions, num_nodes, adj)
+        return adj
+
     def forward(self, x, edge_index, edge_weight=None):
         if edge_weight is None:
             edge_weight = torch.ones(edge_index.size(1), device=self.device, requires_grad=True)
+        adj = self.get_adj(edge_index, edge_weight, len(x))
         for layer in self.layers[:-1]:
-            x = layer(x, edge_index, edge_weight)
+            x = layer(x, edge_index, edge_weight, adj=adj)
             x = F.relu(x)
             x = F.dropout(x, self.dropout, training=self.training)
         self.embedding_tensor = x
-        x = self.layers[-1](x, edge_index, edge_weight)
+        x = self.layers[-1](x, edge_index, edge_weight, adj=adj)
         self.logits = x
-        self.probs = F.softmax(x, dim=1)
-        return self.probs
+        # return the local tensor: the attributes may be overwritten by a concurrent forward of another thread
+        probs = F.softmax(x, dim=1)
+        self.probs = probs
+        return probs
 
     def loss(self, pred, label):
         return F.nll_loss(pred, label)
@@ -94,8 +133,9 @@ class GCN(nn.Module):
     def get_emb(self, x, edge_index, edge_weight=None):
         if edge_weight is None:
             edge_weight = torch.ones(edge_index.size(1), device=self.device, requires_grad=True)
+        adj = self.get_adj(edge_index, edge_weight, len(x))
         for layer in self.layers[:-1]:
-            x = layer(x, edge_index, edge_weight)
+            x = layer(x, edge_index, edge_weight, adj=adj)
             x = F.relu(x)
             x = F.dropout(x, self.dropout, training=self.training)
         return x
@@ -108,6 +148,52 @@ class GCN(nn.Module):
 
 
 
+### Sparse adjacency for large synthetic graphs ###
+class SparseAdj(object):
+    """Batch of adjacency matrices stored as a list of weighted edges instead of a dense [B x N x N] tensor.
+
+    The edges of the b-th graph are offset by b * num_nodes so that the batch is a single block-diagonal graph.
+    As for the dense adjacency, row edge_index[0] aggregates the messages of column edge_index[1].
+    Gradients flow back to the edge weights.
+    """
+
+    def __init__(self, edge_index, edge_weight, batch_size, num_nodes):
+        self.edge_index = edge_index
+        self.edge_weight = edge_weight
+        self.batch_size = batch_size
+        self.num_nodes = num_nodes
+
+    @classmethod
+    def from_edge_index(cls, edge_index, edge_weight, max_n, device=None):
+        """Build the adjacency of a batch from lists (or stacked tensors) of edge_index and edge_weight."""
+        edge_indices, edge_weights = [], []
+        for i in range(len(edge_index)):
+            edge_indices.append(edge_index[i].to(device).long() + i * max_n)
+            edge_weights.append(torch.as_tensor(edge_weight[i], dtype=torch.float).to(device))
+        return cls(torch.cat(edge_indices, dim=1), torch.cat(edge_weights), len(edge_index), max_n)
+
+    def size(self, dim=None):
+        size = torch.Size((self.batch_size, self.num_nodes, self.num_nodes))
+        return size if dim is None else size[dim]
+
+    def to(self, device):
+        return SparseAdj(self.edge_index.to(device), self.edge_weight.to(device), self.batch_size, self.num_nodes)
+
+    def multiply_edges(self, x):
+        """Multiply the weight of each edge (i, j) by <x_i, x_j>, the sparse equivalent of adj * (x @ x^T)."""
+        x = x.reshape(self.batch_size * self.num_nodes, -1)
+        row, col = self.edge_index
+        edge_weight = self.edge_weight * (x[row] * x[col]).sum(dim=-1)
+        return SparseAdj(self.edge_index, edge_weight, self.batch_size, self.num_nodes)
+
+    def matmul(self, x):
+        """Equivalent of torch.matmul(adj, x) for x of size [B x N x F]."""
+        x = x.reshape(self.batch_size * self.num_nodes, -1)
+        row, col = self.edge_index
+        out = torch.zeros_like(x).index_add_(0, row, x[col] * self.edge_weight.unsqueeze(-1))
+        return out.reshape(self.batch_size, self.num_nodes, -1)
+
+
 ### GCN basic operation for Synthetic dataset ###
 class GraphConv(nn.Module):
     def __init__(
@@ -151,15 +237,21 @@ class GraphConv(nn.Module):
             x_att = torch.matmul(x, self.att_weight)
             # import pdb
             # pdb.set_trace()
-            att = x_att @ x_att.permute(0, 2, 1)
-            # att = self.softmax(att)
-            adj = adj * att
+            if isinstance(adj, SparseAdj):
+                adj = adj.multiply_edges(x_att)
+            else:
+                att = x_att @ x_att.permute(0, 2, 1)
+                # att = self.softmax(att)
+                adj = adj * att
 
         adj = adj.to(self.device)
         x = x.to(self.device)
         self.weight = nn.Parameter(self.weight.to(self.device))
 
-        y = torch.matmul(adj, x)
+        if isinstance(adj, SparseAdj):
+            y = adj.matmul(x)
+        else:
+            y = torch.matmul(adj, x)
         y = torch.matmul(y, self.weight)
         if self.add_self:
             self_emb = torch.matmul(x, self.self_weight)
@@ -174,6 +266,9 @@ class GraphConv(nn.Module):
 
 
 class GcnEncoderGraph(nn.Module):
+    # forward accepts a batch of graphs: x [B x N x F] and edge_index [B x 2 x E]
+    batched_input = True
+
     def __init__(
         self,
         input_dim,
@@ -201,6 +296,9 @@ class GcnEncoderGraph(nn.Module):
             self.att = True
         else:
             self.att = False
+        # args saved before the sparse path was added have neither option: use the parser defaults
+        self.sparse_adj = getattr(args, "sparse_adj", "auto")
+        self.sparse_adj_threshold = getattr(args, "sparse_adj_threshold", 5000)
         # if args is not None:
         # self.bias = args.bias
 
@@ -301,8 +399,41 @@ class GcnEncoderGraph(nn.Module):
         out = out_tensor.unsqueeze(2).to(self.device)
         return out
 
-    def apply_bn(self, x):
-        """Batch normalization of 3D tensor x"""
+    def use_sparse_adj(self, num_nodes):
+        """Dense adjacency matrices take O(N^2) memory: switch to SparseAdj above sparse_adj_threshold nodes."""
+        if self.sparse_adj == "auto":
+            return num_nodes > self.sparse_adj_threshold
+        return eval(self.sparse_adj)
+
+    def build_adj(self, edge_index, edge_weight, max_n):
+        """Adjacency of a batch of graphs given as lists (or stacked tensors) of edge_index and edge_weight.
+
+        The dense adjacency is built through scipy and detaches the edge weights: weights that require gradients
+        (e.g. the edge mask of an explainer) always go through SparseAdj.
+        """
+        requires_grad = any(torch.is_tensor(weight) and weight.requires_grad for weight in edge_weight)
+        if requires_grad or self.use_sparse_adj(max_n):
+            return SparseAdj.from_edge_index(edge_index, edge_weight, max_n, device=self.device)
+        adj = []
+        for i in range(len(edge_index)):
+            adj.append(from_edge_index_to_adj(edge_index[i].cpu(), edge_weight[i].cpu().float(), max_n))
+        return torch.stack(adj).to(self.device)
+
+    @staticmethod
+    def stack_adj_att(adj_att_all):
+        # attention weights of a sparse adjacency are not materialized as a dense tensor
+        if any(isinstance(adj_att, SparseAdj) for adj_att in adj_att_all):
+            return None
+        return torch.stack(adj_att_all, dim=3)
+
+    def apply_bn(self, x, per_graph_bn=False):
+        """Batch normalization of 3D tensor x
+
+        With per_graph_bn, each graph of the batch is normalized with its own statistics, as if it was
+        given alone.
+        """
+        if per_graph_bn:
+            return F.layer_norm(x, x.size()[2:])
         bn_module = nn.BatchNorm1d(x.size()[1]).to(self.device)
         return bn_module(x)
 
@@ -338,10 +469,10 @@ class GcnEncoderGraph(nn.Module):
             x_tensor = x_tensor * embedding_mask
         self.embedding_tensor = x_all[-1]
         # adj_att_tensor: [batch_size x num_nodes x num_nodes x num_gc_layers]
-        adj_att_tensor = torch.stack(adj_att_all, dim=3)
+        adj_att_tensor = self.stack_adj_att(adj_att_all)
         return x_tensor, adj_att_tensor
 
-    def forward_batch(self, x, adj, batch_num_nodes=None, **kwargs):
+    def forward_batch(self, x, adj, batch_num_nodes=None, per_graph_bn=False, **kwargs):
         # mask
         max_num_nodes = adj.size()[1]
         if batch_num_nodes is not None:
@@ -353,7 +484,7 @@ class GcnEncoderGraph(nn.Module):
         x, adj_att = self.conv_first(x, adj)
         x = self.act(x)
         if self.bn:
-            x = self.apply_bn(x)
+            x = self.apply_bn(x, per_graph_bn=per_graph_bn)
         out_all = []
         out, _ = torch.max(x, dim=1)
         out_all.append(out)
@@ -362,7 +493,7 @@ class GcnEncoderGraph(nn.Module):
             x, adj_att = self.conv_block[i](x, adj)
             x = self.act(x)
             if self.bn:
-                x = self.apply_bn(x)
+                x = self.apply_bn(x, per_graph_bn=per_graph_bn)
             out, _ = torch.max(x, dim=1)
             out_all.append(out)
             if self.num_aggs == 2:
@@ -383,7 +514,7 @@ class GcnEncoderGraph(nn.Module):
             output = out
 
         # adj_att_tensor: [batch_size x num_nodes x num_nodes x num_gc_layers]
-        adj_att_tensor = torch.stack(adj_att_all, dim=3)
+        adj_att_tensor = self.stack_adj_att(adj_att_all)
 
         self.embedding_tensor = output
         ypred = self.pred_model(output)
@@ -402,11 +533,7 @@ class GcnEncoderGraph(nn.Module):
         if edge_weight is None:
             edge_weight = init_weights(edge_index)
 
-        adj = []
-        for i in range(len(x)):
-            max_n = x[i].size(0)
-            adj.append(from_edge_index_to_adj(edge_index[i].cpu(), torch.FloatTensor(edge_weight[i]), max_n))
-        adj = torch.stack(adj).to(self.device)
+        adj = self.build_adj(edge_index, edge_weight, x.size(1))
         pred, adj_att = self.forward_batch(x, adj, batch_num_nodes, **kwargs)
         self.logits = pred
         self.probs = F.softmax(pred, dim=1)
@@ -457,7 +584,7 @@ class GcnEncoderGraph(nn.Module):
             output = out
 
         # adj_att_tensor: [batch_size x num_nodes x num_nodes x num_gc_layers]
-        adj_att_tensor = torch.stack(adj_att_all, dim=3)
+        adj_att_tensor = self.stack_adj_att(adj_att_all)
 
         self.embedding_tensor = output
         ypred = self.pred_model(output)
@@ -478,6 +605,9 @@ class GcnEncoderGraph(nn.Module):
 
 
 class GcnEncoderNode(GcnEncoderGraph):
+    # forward takes a single graph
+    batched_input = False
+
     def __init__(
         self,
         input_dim,
@@ -532,8 +662,8 @@ class GcnEncoderNode(GcnEncoderGraph):
         if edge_weight is None:
             edge_weight = torch.ones(edge_index.size(1))
         max_n = x.size(0)
-        adj = from_edge_index_to_adj(edge_index, edge_weight, max_n).to(self.device)
-        pred, adj_att = self.forward_batch(x.expand(1, -1, -1), adj.expand(1, -1, -1), batch_num_nodes=None, **kwargs)
+        adj = self.build_adj([edge_index], [edge_weight], max_n)
+        pred, adj_att = self.forward_batch(x.expand(1, -1, -1), adj, batch_num_nodes=None, **kwargs)
         ypred = torch.squeeze(pred, 0)
         self.logits = ypred
         self.probs = F.softmax(ypred, dim=1)
@@ -550,13 +680,13 @@ class GcnEncoderNode(GcnEncoderGraph):
         if edge_weight is None:
             edge_weight = torch.ones(edge_index.size(1))
         max_n = x.size(0)
-        adj = from_edge_index_to_adj(edge_index, edge_weight, max_n).to(self.device)
+        adj = self.build_adj([edge_index], [edge_weight], max_n)
         # mask
         max_num_nodes = adj.size()[1]
         embedding_mask = None
         self.adj_atts = []
         x_tensor, adj_att = self.gcn_forward(
-            x.expand(1, -1, -1), adj.expand(1, -1, -1), self.conv_first, self.conv_block, self.conv_last, embedding_mask
+            x.expand(1, -1, -1), adj, self.conv_first, self.conv_block, self.conv_last, embedding_mask
         )
         emb = torch.squeeze(x_tensor, 0)
         return emb
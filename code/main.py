@@ -17,15 +17,17 @@ from dataset.gen_real import load_data_real
 from dataset.data_utils import get_split, split_data
 from dataset.mutag_utils import data_to_graph
 from evaluate.accuracy import eval_accuracy
-from evaluate.fidelity import eval_fidelity, eval_related_pred_nc
-from evaluate.mask_utils import clean_masks, get_mask_info, get_ratio_connected_components, get_size, get_sparsity, normalize_all_masks, transform_mask
+from evaluate.fidelity import eval_fidelity, eval_related_pred_nc, eval_related_pred_nc_sweep
+from evaluate.mask_utils import clean_masks, get_mask_info, get_ratio_connected_components, get_size, get_sparsity, normalize_all_masks, transform_mask, transform_mask_sweep
 from explainer.genmask import compute_edge_masks_nc
+from explainer.subgraphx import reward_cache, reward_evaluations
 from gnn.eval import gnn_scores_gc, gnn_scores_nc, gnn_accuracy
 from gnn.model import GCN, GcnEncoderGraph, GcnEncoderNode
 from gnn.train import train_graph_classification, train_node_classification, train_real
+from utils.cache_utils import subgraph_cache
 from utils.gen_utils import gen_dataloader, get_test_graphs, get_test_nodes
 from utils.graph_utils import get_edge_index_batch, split_batch
-from utils.io_utils import check_dir, create_data_filename, create_mask_filename, create_model_filename, load_ckpt, save_checkpoint
+from utils.io_utils import check_dir, create_data_filename, create_model_filename, load_ckpt, save_checkpoint
 from utils.parser_utils import arg_parse, get_data_args, get_graph_size_args
 from utils.plot_utils import plot_expl_gc, plot_feat_importance, plot_masks_density
 
@@ -43,6 +45,8 @@ def main_real(args):
     if torch.cuda.is_available():
         torch.cuda.manual_seed(args.seed)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    subgraph_cache.resize(args.subgraph_cache_size)
+    reward_cache.resize(args.reward_cache_size)
 
     check_dir(args.data_save_dir)
     data_dir = os.path.join(args.data_save_dir, args.dataset)
@@ -90,6 +94,7 @@ def main_real(args):
             dropout=args.dropout,
             num_layers=args.num_gc_layers,
             device=device,
+            cached=eval(args.cache_adj),
         )
     else:
         model = GCN(
@@ -99,6 +104,7 @@ def main_real(args):
             dropout=args.dropout,
             num_layers=args.num_gc_layers,
             device=device,
+            cached=eval(args.cache_adj),
         )
         train_real(model, data, device, args)
         results_train, results_test = gnn_scores_nc(model, data, args, device)
@@ -113,23 +119,9 @@ def main_real(args):
 
     ### Explainer ###
     list_test_nodes = get_test_nodes(data, model, args)
-    mask_filename = create_mask_filename(args)
     edge_masks, node_feat_masks, Time = compute_edge_masks_nc(list_test_nodes, model, data, device, args)
-    """
-    if args.dataset.startswith("ebay"):
-        edge_masks, node_feat_masks, Time = compute_edge_masks_nc(list_test_nodes, model, data, device, args)
-        
-    else:
-        if (os.path.isfile(mask_filename)) & (args.explainer_name not in ["sa", "ig"]):
-            with open(mask_filename, 'rb') as f:
-                w_list = pickle.load(f)
-            edge_masks, node_feat_masks, Time = tuple(w_list)
-        else:
-            edge_masks, node_feat_masks, Time = compute_edge_masks_nc(list_test_nodes, model, data, device, args)
-            if args.explainer_name not in ["sa", "ig"]:
-                with open(mask_filename, 'wb') as f:
-                    pickle.dump([edge_masks, node_feat_masks, Time], f)
-    """
+    print("__subgraph_cache_infos:" + json.dumps(subgraph_cache.info()))
+    print("__reward_cache_infos:" + json.dumps(reward_cache.info()))
 
     args.E = False if edge_masks[0] is None else True
     args.NF = False if node_feat_masks[0] is None else True
@@ -147,6 +139,8 @@ def main_real(args):
             "num_test_final": args.num_test_final,
             "groundtruth target": args.true_label_as_target,
             "time": float(format(np.mean(Time), ".4f")),}
+    infos.update(args.convergence_infos)
+    infos.update(reward_evaluations.info())
 
     
     if args.E:
@@ -189,18 +183,19 @@ def main_real(args):
         params_lst = [eval(i) for i in args.params_list.split(',')]
     
         edge_masks_ori = edge_masks.copy()
-        for param in params_lst:
+        ### Mask transformation and fidelity for all the params at once ###
+        edge_masks_sweep = transform_mask_sweep(edge_masks_ori, data, params_lst, args)
+        related_preds_sweep = eval_related_pred_nc_sweep(model, data, edge_masks_sweep, node_feat_masks, list_test_nodes, device, args)
+        for param, edge_masks, related_preds in zip(params_lst, edge_masks_sweep, related_preds_sweep):
             params_transf = {args.strategy: param}
 
             ### Mask transformation ###
-            edge_masks = transform_mask(edge_masks_ori, data, param, args)
             if (eval(args.hard_mask)==False)&(args.seed==10):
                 plot_masks_density(edge_masks, args, type="edge")
             transformed_mask_infos = {key: value for key, value in sorted(get_mask_info(edge_masks, data.edge_index).items() | params_transf.items())}
             print("__transformed_mask_infos:" + json.dumps(transformed_mask_infos))
 
             ### Fidelity ###
-            related_preds = eval_related_pred_nc(model, data, edge_masks, node_feat_masks, list_test_nodes, device, args)
             fidelity = eval_fidelity(related_preds, args)
             fidelity_scores = {key: value for key, value in sorted(fidelity.items() | params_transf.items())}
             print("__fidelity:" + json.dumps(fidelity_scores))
@@ -219,6 +214,8 @@ def main_syn(args):
     if torch.cuda.is_available():
         torch.cuda.manual_seed(args.seed)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    subgraph_cache.resize(args.subgraph_cache_size)
+    reward_cache.resize(args.reward_cache_size)
 
     ### Generate, Save, Load data ###
     check_dir(args.data_save_dir)
@@ -277,17 +274,9 @@ def main_syn(args):
     
     ### Explain ###
     list_test_nodes = get_test_nodes(data, model, args)
-    mask_filename = create_mask_filename(args)
-
-    """if os.path.isfile(mask_filename):
-        with open(mask_filename, 'rb') as f:
-            w_list = pickle.load(f)
-        edge_masks, node_feat_masks, Time = tuple(w_list)
-    else:
-        edge_masks, node_feat_masks, Time = compute_edge_masks_nc(list_test_nodes, model, data, device, args)
-        with open(mask_filename, 'wb') as f:
-            pickle.dump([edge_masks, node_feat_masks, Time], f)"""
     edge_masks, node_feat_masks, Time = compute_edge_masks_nc(list_test_nodes, model, data, device, args)
+    print("__subgraph_cache_infos:" + json.dumps(subgraph_cache.info()))
+    print("__reward_cache_infos:" + json.dumps(reward_cache.info()))
     
     args.E = False if edge_masks[0] is None else True
     args.NF = False if node_feat_masks[0] is None else True
@@ -306,6 +295,8 @@ def main_syn(args):
             "num_test_final": args.num_test_final,
             "groundtruth target": args.true_label_as_target,
             "time": float(format(np.mean(Time), ".4f")),}
+    infos.update(args.convergence_infos)
+    infos.update(reward_evaluations.info())
     
     if args.E:
         ### Mask normalisation and cleaning ###
@@ -361,12 +352,14 @@ def main_syn(args):
             params_lst = [eval(i) for i in args.params_list.split(',')]
         
             edge_masks_ori = edge_masks.copy()
-            for param in params_lst:
+            ### Mask transformation and fidelity for all the params at once ###
+            edge_masks_sweep = transform_mask_sweep(edge_masks_ori, data, params_lst, args)
+            related_preds_sweep = eval_related_pred_nc_sweep(model, data, edge_masks_sweep, node_feat_masks, list_test_nodes, device, args)
+            for param, edge_masks, related_preds in zip(params_lst, edge_masks_sweep, related_preds_sweep):
                 params_transf = {args.strategy: param}
                 args.param = param
 
                 ### Mask transformation ###
-                edge_masks = transform_mask(edge_masks_ori, data, param, args)
                 if (eval(args.hard_mask)==False)&(args.seed==10):
                     plot_masks_density(edge_masks, args, type="edge")
                 transformed_mask_infos = {key: value for key, value in sorted(get_mask_info(edge_masks, data.edge_index).items() | params_transf.items())}
@@ -378,7 +371,6 @@ def main_syn(args):
                 print("__accuracy:" + json.dumps(accuracy_scores))
 
                 ### Fidelity ###
-                related_preds = eval_related_pred_nc(model, data, edge_masks, node_feat_masks, list_test_nodes, device, args)
                 fidelity = eval_fidelity(related_preds, args)
                 fidelity_scores = {key: value for key, value in sorted(fidelity.items() | params_transf.items())}
                 print("__fidelity:" + json.dumps(fidelity_scores))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the code directory are imported as top-level packages (utils, explainer, ...), as in main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
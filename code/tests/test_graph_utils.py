@@ -0,0 +1,44 @@
+import networkx as nx
+import numpy as np
+from utils.graph_utils import CSRGraph
+
+
+def small_graph():
+    graph = nx.Graph()
+    graph.add_nodes_from(range(8))
+    # two triangles joined by the edge (2, 3), a self-loop on 1, a pendant node 6 and an isolated node 7
+    graph.add_edges_from([(0, 1), (1, 2), (0, 2), (2, 3), (3, 4), (4, 5), (3, 5), (5, 6), (1, 1)])
+    return graph
+
+
+def components_from_labels(labels):
+    nodes = np.nonzero(labels >= 0)[0]
+    return sorted(sorted(nodes[labels[nodes] == label].tolist()) for label in np.unique(labels[nodes]))
+
+
+def test_degree_matches_networkx():
+    graph = small_graph()
+    csr_graph = CSRGraph.from_networkx(graph)
+    for nodes in [range(8), [0, 1, 2, 3], [1, 3, 5, 6], [7]]:
+        mask = csr_graph.node_mask(nodes)
+        degree = csr_graph.degree(mask)
+        expected = dict(graph.subgraph(nodes).degree())
+        assert all(degree[node] == expected[node] for node in nodes)
+        assert not degree[~mask].any()
+
+
+def test_connected_components_match_networkx():
+    graph = small_graph()
+    csr_graph = CSRGraph.from_networkx(graph)
+    list_nodes = [range(8), [0, 1, 2, 4, 5, 6], [1, 3, 6, 7], [2, 3]]
+    labels = csr_graph.connected_components(np.stack([csr_graph.node_mask(nodes) for nodes in list_nodes]))
+    for nodes, row in zip(list_nodes, labels):
+        expected = sorted(sorted(component) for component in nx.connected_components(graph.subgraph(nodes)))
+        assert components_from_labels(row) == expected
+
+
+def test_largest_component():
+    graph = small_graph()
+    csr_graph = CSRGraph.from_networkx(graph)
+    labels = csr_graph.connected_components(csr_graph.node_mask([0, 1, 2, 4, 5, 6]))[0]
+    assert sorted(CSRGraph.largest_component(labels).tolist()) == [0, 1, 2]
@@ -0,0 +1,141 @@
+""" cache_utils.py
+    In-memory caches shared by the explainers and the evaluation.
+"""
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+from torch_geometric.utils import k_hop_subgraph
+from torch_geometric.utils.num_nodes import maybe_num_nodes
+
+# id(tensor) -> (weak reference to the tensor, version of the tensor when hashed, digest)
+_fingerprints = {}
+
+
+def tensor_fingerprint(tensor):
+    """Content hash of a tensor, computed once per tensor object and version."""
+    key = id(tensor)
+    entry = _fingerprints.get(key)
+    if entry is not None and entry[0]() is tensor and entry[1] == tensor._version:
+        return entry[2]
+    digest = hashlib.sha1(tensor.detach().cpu().numpy().tobytes()).hexdigest()
+    ref = weakref.ref(tensor, lambda _, key=key: _fingerprints.pop(key, None))
+    _fingerprints[key] = (ref, tensor._version, digest)
+    return digest
+
+
+def graph_fingerprint(edge_index, num_nodes=None):
+    """Identify a graph by the content of its edge_index and its number of nodes."""
+    num_nodes = maybe_num_nodes(edge_index, num_nodes)
+    return tensor_fingerprint(edge_index), tuple(edge_index.shape), num_nodes, str(edge_index.device)
+
+
+class LRUCache(object):
+    """Dictionary bounded to `max_size` entries, evicting the least recently used entry first.
+
+    The operations hold a lock, so that the caches can be shared by the worker threads of SubgraphX.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self._evict()
+
+    def pop_counts(self):
+        """Return and reset the hit and miss counts, e.g. to send them from a worker process to merge_counts."""
+        with self.lock:
+            counts = (self.hits, self.misses)
+            self.hits = 0
+            self.misses = 0
+        return counts
+
+    def merge_counts(self, counts):
+        with self.lock:
+            self.hits += counts[0]
+            self.misses += counts[1]
+
+    def _evict(self):
+        while len(self.entries) > max(self.max_size, 0):
+            self.entries.popitem(last=False)
+
+    def info(self):
+        with self.lock:
+            hits, misses, size = self.hits, self.misses, len(self.entries)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total > 0 else 0.0,
+            "size": size,
+        }
+
+
+class SubgraphCache(LRUCache):
+    """Cache of the k-hop computation subgraphs of the nodes.
+
+    An entry is keyed by (graph fingerprint, node_idx, num_hops, flow) and holds the output of
+    `torch_geometric.utils.k_hop_subgraph` with relabelled nodes: (subset, edge_index, mapping, edge_mask).
+    The cached tensors are shared between callers and must not be modified in place.
+    """
+
+    def k_hop_subgraph(self, node_idx, num_hops, edge_index, num_nodes=None, flow="source_to_target"):
+        num_nodes = maybe_num_nodes(edge_index, num_nodes)
+        if torch.is_tensor(node_idx):
+            node_idx = node_idx.flatten().tolist()
+            node_idx = node_idx[0] if len(node_idx) == 1 else tuple(node_idx)
+        if isinstance(node_idx, (list, tuple)):
+            node_idx = tuple(int(idx) for idx in node_idx)
+        else:
+            node_idx = int(node_idx)
+        key = (graph_fingerprint(edge_index, num_nodes), node_idx, num_hops, flow)
+        value = self.get(key)
+        if value is None:
+            value = k_hop_subgraph(
+                list(node_idx) if isinstance(node_idx, tuple) else node_idx,
+                num_hops,
+                edge_index,
+                relabel_nodes=True,
+                num_nodes=num_nodes,
+                flow=flow,
+            )
+            self.put(key, value)
+        return value
+
+
+subgraph_cache = SubgraphCache()
+
+
+def cached_k_hop_subgraph(node_idx, num_hops, edge_index, num_nodes=None, flow="source_to_target"):
+    """Drop-in replacement of `k_hop_subgraph(..., relabel_nodes=True)` backed by the shared subgraph cache."""
+    return subgraph_cache.k_hop_subgraph(node_idx, num_hops, edge_index, num_nodes=num_nodes, flow=flow)
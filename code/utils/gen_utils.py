@@ -8,7 +8,12 @@ from dataset.mutag_utils import GraphSampler, data_to_graph
 from scipy.sparse import csr_matrix
 import scipy.sparse as sp
 from scipy.special import softmax
-from torch_geometric.utils import from_scipy_sparse_matrix, k_hop_subgraph, to_scipy_sparse_matrix
+from torch_geometric.utils import from_scipy_sparse_matrix, to_scipy_sparse_matrix
+from utils.cache_utils import cached_k_hop_subgraph
+
+# The GNNs aggregate the messages of edge_index[1] into edge_index[0]: the computation subgraph of a node
+# is the set of nodes reached by following its edges num_hops times from edge_index[0] to edge_index[1].
+LOCAL_INFERENCE_FLOW = "target_to_source"
 
 
 def list_to_dict(preds):
@@ -31,9 +36,7 @@ def sample_large_graph(data):
 def get_subgraph(node_idx, x, edge_index, num_hops, **kwargs):
     num_nodes, num_edges = x.size(0), edge_index.size(1)
 
-    subset, edge_index, mapping, edge_mask = k_hop_subgraph(
-        node_idx, num_hops, edge_index, relabel_nodes=True, num_nodes=num_nodes
-    )
+    subset, edge_index, mapping, edge_mask = cached_k_hop_subgraph(node_idx, num_hops, edge_index, num_nodes=num_nodes)
 
     x = x[subset]
     for key, item in kwargs.items():
@@ -193,6 +196,18 @@ def get_test_nodes(data, model, args):
     return list_test_nodes
 
 
+def get_node_seed(seed, node_idx):
+    """Derive a per-node seed so that the explanation of a node does not depend on the nodes explained before it."""
+    return (seed * 1000003 + int(node_idx)) % (2**32)
+
+
+def set_node_seed(seed, node_idx):
+    node_seed = get_node_seed(seed, node_idx)
+    random.seed(node_seed)
+    np.random.seed(node_seed)
+    torch.manual_seed(node_seed)
+
+
 def get_test_graphs(data, args):
     list_test_idx = np.random.randint(0, len(data), args.num_test)
     test_data = [data[index] for index in list_test_idx]
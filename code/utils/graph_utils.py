@@ -1,9 +1,127 @@
 import numpy as np
 import torch
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from torch.autograd import Variable
 
+from utils.cache_utils import LRUCache, graph_fingerprint
 from utils.gen_utils import from_adj_to_edge_index
 
+# graph fingerprint -> reverse-edge permutation of the graph
+reverse_edge_cache = LRUCache(max_size=64)
+
+
+def get_reverse_edge_index(edge_index, num_nodes=None):
+    """Index of the reverse edge (v, u) of each edge (u, v), or -1 if the reverse edge does not exist.
+
+    Edges that appear more than once, or whose reverse edge appears more than once, have no well-defined
+    twin and get -1 as well. The permutation is computed in O(E log E) once per graph and cached.
+    """
+    key = graph_fingerprint(edge_index, num_nodes)
+    reverse = reverse_edge_cache.get(key)
+    if reverse is not None:
+        return reverse
+    num_nodes = key[2]
+    u, v = edge_index.cpu().numpy().astype(np.int64)
+    edge_keys = u * num_nodes + v
+    reverse_keys = v * num_nodes + u
+    order = np.argsort(edge_keys, kind="stable")
+    sorted_keys = edge_keys[order]
+    unique_keys, counts = np.unique(sorted_keys, return_counts=True)
+    pos = np.searchsorted(sorted_keys, reverse_keys)
+    found = (pos < len(sorted_keys)) & (sorted_keys[np.minimum(pos, len(sorted_keys) - 1)] == reverse_keys)
+    reverse = np.where(found, order[np.minimum(pos, len(order) - 1)], -1)
+    count = counts[np.searchsorted(unique_keys, edge_keys)]
+    reverse_count = np.zeros_like(count)
+    reverse_count[found] = count[reverse[found]]
+    reverse[(count != 1) | (reverse_count != 1)] = -1
+    reverse_edge_cache.put(key, reverse)
+    return reverse
+
+
+class CSRGraph(object):
+    """Undirected graph stored as CSR arrays, for repeated queries on node-induced subgraphs.
+
+    The subgraphs are given as boolean node masks, so that degrees and connected components of many
+    candidate subgraphs are computed with array operations instead of building graph objects.
+
+    Args:
+        indptr (ndarray): CSR row pointers, of size num_nodes + 1.
+        indices (ndarray): CSR column indices, both directions of each undirected edge, without self-loops.
+        self_loops (ndarray, optional): boolean, True for the nodes with a self-loop. As in networkx, a self-loop
+            counts 2 in the degree of its node; it does not change the connected components.
+    """
+
+    def __init__(self, indptr, indices, self_loops=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.num_nodes = len(self.indptr) - 1
+        self.rows = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+        if self_loops is None:
+            self_loops = np.zeros(self.num_nodes, dtype=bool)
+        self.self_loops = np.asarray(self_loops, dtype=bool)
+
+    @classmethod
+    def from_edges(cls, edges, num_nodes):
+        """Build the graph from (u, v) pairs on nodes 0..num_nodes-1; duplicates are dropped."""
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        loops = edges[:, 0] == edges[:, 1]
+        self_loops = np.zeros(num_nodes, dtype=bool)
+        self_loops[edges[loops, 0]] = True
+        edges = edges[~loops]
+        u = np.concatenate([edges[:, 0], edges[:, 1]])
+        v = np.concatenate([edges[:, 1], edges[:, 0]])
+        keys = np.unique(u * num_nodes + v)
+        u, v = keys // num_nodes, keys % num_nodes
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(u, minlength=num_nodes), out=indptr[1:])
+        return cls(indptr, v, self_loops)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """Build the graph from a networkx graph whose nodes are 0..n-1."""
+        return cls.from_edges(list(graph.edges()), graph.number_of_nodes())
+
+    def node_mask(self, nodes):
+        mask = np.zeros(self.num_nodes, dtype=bool)
+        mask[np.asarray(list(nodes), dtype=np.int64)] = True
+        return mask
+
+    def degree(self, mask):
+        """Degree of each node in the subgraph induced by mask (0 outside of the mask), as networkx counts it."""
+        inside = mask[self.rows] & mask[self.indices]
+        return np.bincount(self.rows[inside], minlength=self.num_nodes) + 2 * (self.self_loops & mask)
+
+    def connected_components(self, masks):
+        """Connected components of the subgraphs induced by each node mask of masks [K x num_nodes].
+
+        The K subgraphs are labelled in one call on their disjoint union.
+
+        Returns:
+            labels [K x num_nodes]: component label of each node in its subgraph (comparable within a row
+            only), -1 outside of the mask.
+        """
+        masks = np.atleast_2d(masks)
+        K, n = masks.shape
+        graph_idx, edge_idx = np.nonzero(masks[:, self.rows] & masks[:, self.indices])
+        offsets = graph_idx * n
+        adj = csr_matrix(
+            (np.ones(len(edge_idx), dtype=np.int8), (self.rows[edge_idx] + offsets, self.indices[edge_idx] + offsets)),
+            shape=(K * n, K * n),
+        )
+        _, labels = connected_components(adj, directed=False)
+        labels = labels.reshape(K, n)
+        labels[~masks] = -1
+        return labels
+
+    @staticmethod
+    def largest_component(labels):
+        """Nodes of the largest component of one row of labels; ties go to the component of the smallest node."""
+        nodes = np.nonzero(labels >= 0)[0]
+        component_labels, first, counts = np.unique(labels[nodes], return_index=True, return_counts=True)
+        best = np.lexsort((first, -counts))[0]
+        return nodes[labels[nodes] == component_labels[best]]
+
 
 def split_batch(lst, n):
     """Returns n-sized batches from lst."""
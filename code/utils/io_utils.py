@@ -68,19 +68,11 @@ def create_model_filename(args, isbest=False, num_epochs=-1, **kwargs):
         filename = os.path.join(filename, "best")
     return filename + ".pth.tar"
 
-def create_mask_filename(args):
-    dir = "/cluster/work/zhang/kamara/mask"
-    os.makedirs(dir, exist_ok=True)
-    subdir = os.path.join(dir, args.dataset)
+def create_mask_dir(args, key):
+    """Directory of the explanation masks of a run, identified by key (see utils.mask_store.get_mask_key)."""
+    subdir = os.path.join(args.mask_save_dir, args.dataset, args.explainer_name, key)
     os.makedirs(subdir, exist_ok=True)
-
-    name = args.dataset + "_" + args.explainer_name 
-    name += "_true_label_as_target_" + str(args.true_label_as_target) + "_test" + str(args.num_test)
-    name += "_seed" + str(args.seed)
-    
-    filename = os.path.join(subdir, name)
-    return filename + ".pkl"
-
+    return subdir
 
 
 def save_checkpoint(filename, model, args, results_train, results_test, isbest=False, cg_dict=None):
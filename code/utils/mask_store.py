@@ -0,0 +1,120 @@
+""" mask_store.py
+    Persistent store of the explanation masks of the testing nodes.
+
+    The masks of a run are kept in a directory named after a hash of everything that determines them:
+    dataset, graph, model weights, explainer, explainer hyper-parameters and seed. Each node is stored in its
+    own .npz file, so that a run with other testing nodes reuses the masks of the nodes already explained.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from utils.cache_utils import tensor_fingerprint
+from utils.io_utils import create_mask_dir
+
+# Arguments that change the masks computed by the explainers. Execution options that give the same masks
+# (number of workers, caches, local inference, ...) are not part of the key. The testing nodes are not part
+# of the key either, except with warm start (see get_mask_key_infos).
+EXPLAINER_PARAMS = [
+    "explainer_name",
+    "edge_size",
+    "edge_ent",
+    "num_gc_layers",
+    "num_top_edges",
+    "true_label_as_target",
+    "seed",
+    "early_stopping",
+    "es_patience",
+    "es_rel_tol",
+    "es_mask_tol",
+    "warm_start",
+    "reuse_samples",
+    "subgraphx_workers",
+    "subgraphx_deterministic",
+]
+
+
+def model_fingerprint(model):
+    """Content hash of the weights of the model."""
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def get_mask_key_infos(model, data, args, ordered_nodes=None):
+    """Everything that determines the masks. ordered_nodes is the ordered list of the testing nodes, for the
+    runs in which the mask of a node depends on the nodes explained before it (warm start)."""
+    infos = {"dataset": args.dataset, "model": model_fingerprint(model)}
+    for key in ["x", "edge_index", "edge_weight"]:
+        item = getattr(data, key, None)
+        infos[key] = tensor_fingerprint(item) if item is not None else None
+    for param in EXPLAINER_PARAMS:
+        infos[param] = getattr(args, param, None)
+    if ordered_nodes is not None:
+        infos["ordered_nodes"] = [int(node_idx) for node_idx in ordered_nodes]
+    return infos
+
+
+def get_mask_key(key_infos):
+    return hashlib.sha1(json.dumps(key_infos, sort_keys=True).encode()).hexdigest()
+
+
+class MaskStore(object):
+    """Directory of per-node explanation masks.
+
+    `load(node_idx)` returns (edge_mask, node_feat_mask, duration) or None if the node was never explained.
+    `save` writes to a temporary file and renames it, so that an interrupted write never leaves a corrupted file.
+    """
+
+    def __init__(self, mask_dir, key_infos=None):
+        self.mask_dir = mask_dir
+        os.makedirs(mask_dir, exist_ok=True)
+        if key_infos is not None:
+            self.write_atomic(os.path.join(mask_dir, "key.json"), lambda f: f.write(json.dumps(key_infos, indent=2).encode()))
+
+    def node_filename(self, node_idx):
+        return os.path.join(self.mask_dir, f"node_{int(node_idx)}.npz")
+
+    def __contains__(self, node_idx):
+        return os.path.isfile(self.node_filename(node_idx))
+
+    def write_atomic(self, filename, write):
+        fd, tmp_filename = tempfile.mkstemp(dir=self.mask_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+    def save(self, node_idx, edge_mask, node_feat_mask, duration):
+        arrays = {"duration": np.array(duration, dtype=np.float64)}
+        if edge_mask is not None:
+            arrays["edge_mask"] = np.asarray(edge_mask)
+        if node_feat_mask is not None:
+            arrays["node_feat_mask"] = np.asarray(node_feat_mask)
+        self.write_atomic(self.node_filename(node_idx), lambda f: np.savez_compressed(f, **arrays))
+
+    def load(self, node_idx):
+        filename = self.node_filename(node_idx)
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as arrays:
+            edge_mask = arrays["edge_mask"] if "edge_mask" in arrays else None
+            node_feat_mask = arrays["node_feat_mask"] if "node_feat_mask" in arrays else None
+            duration = float(arrays["duration"])
+        return edge_mask, node_feat_mask, duration
+
+
+def get_mask_store(model, data, args, ordered_nodes=None):
+    """Mask store of the run, or None if the masks are not stored (--mask_cache off)."""
+    if args.mask_cache == "off":
+        return None
+    key_infos = get_mask_key_infos(model, data, args, ordered_nodes=ordered_nodes)
+    return MaskStore(create_mask_dir(args, get_mask_key(key_infos)), key_infos)
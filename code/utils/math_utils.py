@@ -3,7 +3,9 @@
     Math utilities.
 """
 
+import numpy as np
 import torch
+from scipy import stats
 
 
 def exp_moving_avg(x, decay=0.9):
@@ -22,3 +24,43 @@ def tv_norm(input, tv_beta):
     row_grad = torch.mean(torch.abs((img[:-1, :] - img[1:, :])).pow(tv_beta))
     col_grad = torch.mean(torch.abs((img[:, :-1] - img[:, 1:])).pow(tv_beta))
     return row_grad + col_grad
+
+
+def chi_square_tests(data, target):
+    """Pearson chi-square independence test of every column of data against column target.
+
+    Same statistics as scipy.stats.chi2_contingency on the contingency table of the observed values of each pair
+    of columns (as pgmpy's chi_square without conditioning variables), including the Yates correction when
+    the table has one degree of freedom. All the columns are tested with one 3D contingency tensor.
+
+    Args:
+        data: array of discrete values, of size [num_samples x num_columns]
+
+    Returns:
+        (chi2, p_values, dof), arrays of size num_columns
+    """
+    data = np.asarray(data)
+    values, codes = np.unique(data, return_inverse=True)
+    codes = codes.reshape(data.shape)
+    num_samples, num_columns = data.shape
+    V = len(values)
+    # observed[j, a, b]: number of samples with value a in column j and value b in column target
+    flat = (np.arange(num_columns)[None, :] * V + codes) * V + codes[:, [target]]
+    observed = np.bincount(flat.ravel(), minlength=num_columns * V * V).reshape(num_columns, V, V).astype(float)
+
+    row_sums = observed.sum(axis=2, keepdims=True)
+    col_sums = observed.sum(axis=1, keepdims=True)
+    expected = row_sums * col_sums / num_samples
+    dof = ((row_sums[:, :, 0] > 0).sum(axis=1) - 1) * ((col_sums[:, 0, :] > 0).sum(axis=1) - 1)
+
+    # Yates correction for the 2x2 tables
+    diff = expected - observed
+    yates = (dof == 1)[:, None, None]
+    observed = np.where(yates, observed + np.sign(diff) * np.minimum(0.5, np.abs(diff)), observed)
+
+    # the values absent from a column have a zero expected and observed frequency, and do not count
+    terms = np.divide((observed - expected) ** 2, expected, out=np.zeros_like(expected), where=expected > 0)
+    chi2 = terms.sum(axis=(1, 2))
+    chi2[dof == 0] = 0.0
+    p_values = np.where(dof > 0, stats.chi2.sf(chi2, np.maximum(dof, 1)), 1.0)
+    return chi2, p_values, dof
@@ -67,6 +67,7 @@ def arg_parse():
     parser.add_argument("--data_save_dir", help="Directory where benchmark is located", type=str, default="data")
     parser.add_argument("--model_save_dir", help="saving directory for gnn model", type=str, default="model")
     parser.add_argument("--fig_save_dir", help="Directory where figures are saved", type=str, default="figures")
+    parser.add_argument("--mask_save_dir", help="Directory where explanation masks are stored", type=str, default="mask")
     parser.add_argument(
         "--draw_graph",
         help="Draw explanations (subgraph for NC and graph for GC) after training",
@@ -176,6 +177,9 @@ def arg_parse():
 
     parser.add_argument("--method", dest="method", help="Method. Possible values: base, ")
     parser.add_argument("--name_suffix", dest="name_suffix", help="suffix added to the output filename")
+    parser.add_argument("--sparse_adj", help="adjacency of the synthetic GNNs: True (sparse), False (dense) or auto (sparse above sparse_adj_threshold nodes)", type=str, default="auto")
+    parser.add_argument("--cache_adj", help="if True, the GCN reuses its sparse adjacency across forward calls on the same graph tensors", type=str, default="False")
+    parser.add_argument("--sparse_adj_threshold", help="number of nodes above which the auto mode uses a sparse adjacency", type=int, default=5000)
 
     # explainer params
     parser.add_argument("--explain_graph", help="graph classification or node classification", type=str)
@@ -187,6 +191,30 @@ def arg_parse():
     parser.add_argument("--num_test", help="number of testing entities (graphs or nodes)", type=int)
     parser.add_argument("--num_test_final", help="number of testing entities (graphs or nodes) in the final set", type=int)
     parser.add_argument("--time_limit", help="max time for a method to run on testing set", type=int, default=30000)
+    parser.add_argument("--check_inputs", help="if True, check that the explainers do not modify the graph tensors (slow)", type=str, default="False")
+    parser.add_argument("--subgraph_cache_size", help="max number of k-hop computation subgraphs kept in memory", type=int, default=1024)
+    parser.add_argument("--local_inference", help="if True, the node explainers run the model on the computation subgraph of the node only", type=str, default="False")
+    parser.add_argument("--local_inference_checks", help="number of testing nodes whose local and full-graph predictions are compared before explaining with --local_inference True; 0 for all", type=int, default=5)
+    parser.add_argument("--fidelity_batch_size", help="number of testing nodes evaluated in one forward for fidelity; 1 for full-graph forwards", type=int, default=32)
+    parser.add_argument("--fidelity_max_nodes", help="max number of nodes in one batched fidelity forward; models with a dense adjacency are further capped at sparse_adj_threshold nodes", type=int, default=200000)
+    parser.add_argument("--mask_cache", help="off: do not store masks; reuse: reuse the stored masks and explain the missing nodes only (the stored per-node explanation durations of the reused nodes count towards time_limit instead of wall-clock time, so the cut-off only approximately matches a fresh run); refresh: explain all the nodes and overwrite the stored masks", type=str, default="off")
+    parser.add_argument("--checkpoint_every", help="number of explained nodes between two writes of the masks to the mask store", type=int, default=1)
+    parser.add_argument("--resume", help="if True, resume an interrupted run from the masks in the mask store (implies --mask_cache reuse; the time_limit cut-off is then approximate, see --mask_cache)", type=str, default="False")
+    parser.add_argument("--explain_batch_size", help="number of nodes explained together by the explainers with a batched version (gnnexplainer)", type=int, default=1)
+    parser.add_argument("--early_stopping", help="if True, stop the optimization of the mask-learning explainers (gnnexplainer, pgexplainer) when the loss and the masks have converged", type=str, default="False")
+    parser.add_argument("--es_patience", help="number of epochs without change of the loss and the masks before stopping", type=int, default=50)
+    parser.add_argument("--es_rel_tol", help="relative change of the loss below which the loss has not changed", type=float, default=1e-3)
+    parser.add_argument("--es_mask_tol", help="absolute change of the mask values below which the masks have not changed", type=float, default=1e-2)
+    parser.add_argument("--occlusion_batch_size", help="number of single-edge-occluded graphs evaluated in one forward by the occlusion explainer; 1 for one forward per edge", type=int, default=64)
+    parser.add_argument("--pgm_max_batch_nodes", help="max number of nodes in one batched forward of the perturbed graphs of pgmexplainer", type=int, default=200000)
+    parser.add_argument("--warm_start", help="if True, initialize the edge masks of gnnexplainer from the average masks already learned in the run on the same edges", type=str, default="False")
+    parser.add_argument("--reward_cache_size", help="max number of coalition rewards of subgraphx kept in memory and reused across rollouts and nodes; 0 to disable the cache", type=int, default=100000)
+    parser.add_argument("--reuse_samples", help="if True, subgraphx scores the children of a search tree node with the same sampled permutations (common random numbers)", type=str, default="False")
+    parser.add_argument("--subgraphx_workers", help="number of concurrent monte carlo tree search rollouts of subgraphx, with their rewards computed by a pool of threads", type=int, default=1)
+    parser.add_argument("--subgraphx_deterministic", help="if True, the concurrent subgraphx rollouts give reproducible results, independent of the scheduling of the threads", type=str, default="True")
+    parser.add_argument("--subgraphx_batch_rewards", help="if True, subgraphx scores all the children of an expanded search tree node together, with the masks of all their samples evaluated in shared batched forwards", type=str, default="True")
+    parser.add_argument("--subgraphx_max_batch_nodes", help="max number of nodes in one batched forward of the subgraphx rewards", type=int, default=200000)
+    parser.add_argument("--explain_workers", help="number of processes explaining the testing nodes in parallel", type=int, default=1)
     
     parser.add_argument("--strategy", help="strategy for mask transformation", type=str, default="topk") # ["topk", "sparsity", "threshold"]
     parser.add_argument("--params_list", help="list of transformation degrees", type=str, default="5,10")